@@ -0,0 +1,101 @@
+import asyncio
+import math
+
+import instrument
+import robot_io
+from sonar_sampler import SonarSampler
+
+
+# asyncio front end for the motors and sonar:
+#     - move() sends position targets and returns once both encoders
+#       have stopped changing, polling without blocking the event loop;
+#       settled_at is when they were first seen still
+#     - sample_sonar() is a task that feeds a SonarSampler ring at
+#       sonar_rate for as long as it runs, interleaved with the moves, and
+#       settled_sonar_median() takes its readings from after the last move
+#     - sonar_median() gathers readings on its own schedule, for use
+#       without the sampling task
+# Both only wait through bp.sleep_async, so they work against the real
+# board and the simulated one alike.
+class AsyncMotion:
+    def __init__(self, bp, left_port, right_port, sonar_port, *,
+                 one_cm_dist, pi_turn, poll=0.01, sonar_rate=20.0):
+        self.bp = bp
+        self.left_port = left_port
+        self.right_port = right_port
+        self.sonar_port = sonar_port
+        self.one_cm_dist = one_cm_dist
+        self.pi_turn = pi_turn
+        self.poll = poll
+        self.sensor_errors = 0
+        self.sonar = SonarSampler(bp, sonar_port, sonar_rate)
+        self.sampling = None
+        self.settled_at = bp.time()
+
+    def encoders(self):
+        return (self.bp.get_motor_status(self.left_port)[2],
+                self.bp.get_motor_status(self.right_port)[2])
+
+    async def move(self, l_degrees, r_degrees):
+        l_start, r_start = self.encoders()
+        self.bp.set_motor_position(self.left_port, l_start + l_degrees)
+        self.bp.set_motor_position(self.right_port, r_start + r_degrees)
+        previous, previous_at = (l_start, r_start), self.bp.time()
+        while True:
+            await self.bp.sleep_async(self.poll)
+            current = self.encoders()
+            if current == previous:
+                self.settled_at = previous_at
+                return current
+            previous, previous_at = current, self.bp.time()
+
+    async def move_forward(self, dist_cm):
+        degrees = self.one_cm_dist * dist_cm
+        return await self.move(degrees, degrees)
+
+    # Same convention as Robot.turn_by_radian: 0 ~ 2pi to the left, the
+    # part above pi is done as a right turn
+    async def turn(self, turn_left_radian):
+        if turn_left_radian < math.pi:
+            degrees = self.pi_turn * turn_left_radian
+        else:
+            degrees = -self.pi_turn * (2 * math.pi - turn_left_radian)
+        return await self.move(degrees, -degrees)
+
+    # Start (once) the task feeding self.sonar; it runs until
+    # stop_sampling() or the end of the event loop
+    def start_sampling(self):
+        if self.sampling is None:
+            self.sampling = asyncio.ensure_future(self.sample_sonar())
+
+    def stop_sampling(self):
+        if self.sampling is not None:
+            self.sampling.cancel()
+            self.sampling = None
+
+    async def sample_sonar(self):
+        while True:
+            self.sonar.sample_once()
+            await self.bp.sleep_async(self.sonar.period)
+
+    # Median of the latest count readings taken since the last move
+    # settled, waiting for the sampling task to take them
+    async def settled_sonar_median(self, count=5):
+        self.start_sampling()
+        while self.sonar.count_since(self.settled_at) < count:
+            await self.bp.sleep_async(self.poll)
+        return self.sonar.median(count, since=self.settled_at)
+
+    # Median of count good readings taken interval seconds apart.
+    # SensorErrors are counted and the reading retried.
+    async def sonar_median(self, count=11, interval=0.1):
+        readings = []
+        while len(readings) < count:
+            try:
+                readings.append(self.bp.get_sensor(self.sonar_port))
+            except robot_io.SensorError:
+                self.sensor_errors += 1
+                instrument.count("sonar.sensor_error")
+            await self.bp.sleep_async(interval)
+        readings.sort()
+        return readings[count // 2]
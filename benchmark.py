@@ -0,0 +1,178 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+# Benchmarks run against the simulated board and never draw
+os.environ.setdefault("ROBOT_IO", "sim")
+
+import localization
+import tutorial4
+from likelihood_field import DistanceField
+from noise import NoiseSource
+from particles import ParticleSet
+from raycast import SegmentTable, WallTable, wall_segments
+from wall_index import WallGrid
+
+
+PARTICLE_COUNTS = [100, 1000, 10000, 100000]
+WALL_COUNTS = [8, 64, 512]
+# sonar_ground_truth is one ray per call, so cap how many calls we time
+GROUND_TRUTH_CALLS = 1000
+
+
+def random_particles(n, rng):
+    # Spread over the lower-left room of the arena so most rays hit walls
+    return ParticleSet(rng.uniform(5, 205, n), rng.uniform(5, 80, n),
+                       rng.uniform(0, 2 * np.pi, n), np.full(n, 1 / n))
+
+
+# real_walls plus extra random axis-aligned walls inside the arena
+def make_walls(count, rng):
+    walls = list(localization.real_walls)
+    while len(walls) < count:
+        lo, hi = sorted(rng.uniform(0, 210, 2))
+        walls.append(localization.Line(bool(rng.integers(2)), float(rng.uniform(0, 210)), lo, hi))
+    return walls
+
+
+def time_call(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return times, peak
+
+
+def result(name, particles, walls, times, peak, calls=1):
+    median = float(np.median(times)) / calls
+    return {
+        "name": name,
+        "particles": particles,
+        "walls": walls,
+        "seconds_median": median,
+        "seconds_min": float(np.min(times)) / calls,
+        "updates_per_second": 1.0 / median if median > 0 else None,
+        "peak_bytes_per_particle": peak / particles,
+    }
+
+
+def bench_particles(n, repeat, rng, seed):
+    noise = NoiseSource(tutorial4.MOTION_SIGMAS, tutorial4.MOTION_CORRELATION, seed=seed)
+    robot = tutorial4.Robot(l=0, r=0, cms=tutorial4.MoveStatus.WALK_STRAIGHT, noise=noise)
+    tutorial4.SAMPLE_SIZE = n
+    tutorial4.ADAPTIVE_SAMPLE_SIZE = False
+    walls = len(localization.real_walls)
+    base = random_particles(n, rng)
+    out = []
+
+    def run(name, fn):
+        robot.particles = base.copy()
+        times, peak = time_call(fn, repeat)
+        out.append(result(name, n, walls, times, peak))
+
+    run("calc_move_forward_error", lambda: robot.calc_move_forward_error(20))
+    run("calc_turn_error", lambda: robot.calc_turn_error(1.0))
+    # Take the sonar value as read so only the filter is timed, not the
+    # (simulated) sensor sleeps
+    robot.accurate_sonar_read = lambda: 60
+    run("read_sonar_calc_new_samples", robot.read_sonar_calc_new_samples)
+    weighted = robot.read_sonar_calc_new_samples()
+    run("select_survived_samples", lambda: robot.select_survived_samples(weighted))
+    run("cur_pos_no_resample", robot.cur_pos_no_resample)
+    return out
+
+
+def bench_walls(n, wall_count, repeat, rng):
+    walls = make_walls(wall_count, rng)
+    table = WallTable.from_lines(walls)
+    p = random_particles(n, rng)
+    out = []
+
+    times, peak = time_call(lambda: localization.calculate_likelihoods(p.x, p.y, p.theta, 60, walls=table), repeat)
+    out.append(result("calculate_likelihoods", n, wall_count, times, peak))
+
+    # Same walls through the arbitrary-segment kernel
+    segments = SegmentTable.from_segments(wall_segments(walls))
+    times, peak = time_call(lambda: localization.calculate_likelihoods(p.x, p.y, p.theta, 60, walls=segments), repeat)
+    out.append(result("calculate_likelihoods_segments", n, wall_count, times, peak))
+
+    # And through the spatial grid maps.load_map picks for large maps
+    grid = WallGrid(walls)
+    times, peak = time_call(lambda: localization.calculate_likelihoods(p.x, p.y, p.theta, 60, walls=grid), repeat)
+    out.append(result("calculate_likelihoods_grid", n, wall_count, times, peak))
+
+    # Likelihood field: a grid lookup per particle, whatever the wall count
+    field = DistanceField.load_or_build(table)
+    times, peak = time_call(lambda: localization.field_log_likelihoods(p.x, p.y, p.theta, 60, field=field), repeat)
+    out.append(result("field_log_likelihoods", n, wall_count, times, peak))
+
+    calls = min(n, GROUND_TRUTH_CALLS)
+    poses = list(zip(p.x[:calls].tolist(), p.y[:calls].tolist(), p.theta[:calls].tolist()))
+
+    def ground_truth():
+        for x, y, theta in poses:
+            localization.sonar_ground_truth(table, x, y, theta)
+
+    times, peak = time_call(ground_truth, repeat)
+    out.append(result("sonar_ground_truth", calls, wall_count, times, peak, calls))
+    return out
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the tutorial4 localization hot path.")
+    parser.add_argument("--particles", type=int, nargs="+", default=PARTICLE_COUNTS)
+    parser.add_argument("--walls", type=int, nargs="+", default=WALL_COUNTS)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    results = []
+    for n in args.particles:
+        results += bench_particles(n, args.repeat, rng, args.seed)
+        for wall_count in args.walls:
+            results += bench_walls(n, wall_count, args.repeat, rng)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "repeat": args.repeat,
+            "bytes_per_particle": ParticleSet.at(0, 0, 0, 1).x.itemsize * 4,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
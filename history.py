@@ -0,0 +1,120 @@
+import math
+import os
+import time
+
+import numpy as np
+
+from particles import ParticleSet
+
+
+SUMMARY_DTYPE = np.dtype([("step", "<i8"), ("mean", "<f8", 3), ("cov", "<f8", (3, 3)),
+                          ("ess", "<f8"), ("count", "<i8")])
+
+
+# Weighted mean pose, covariance of (x, y, theta) and effective sample size
+# for one particle snapshot. theta is averaged on the unit circle and its
+# spread taken around that mean.
+def summarise(x, y, theta, w):
+    w = w / w.sum()
+    mx, my = np.dot(w, x), np.dot(w, y)
+    mt = math.atan2(np.dot(w, np.sin(theta)), np.dot(w, np.cos(theta))) % (2 * math.pi)
+    dt = (theta - mt + math.pi) % (2 * math.pi) - math.pi
+    d = np.stack([x - mx, y - my, dt])
+    cov = (d * w) @ d.T
+    return (mx, my, mt), cov, 1.0 / np.dot(w, w)
+
+
+# Trajectory history with bounded memory:
+#     - the last `capacity` particle snapshots are kept in full in a
+#       preallocated (capacity, max_particles, 4) float32 ring; larger
+#       sets are evenly subsampled down to max_particles
+#     - a snapshot pushed out of the ring leaves a summary (mean,
+#       covariance, ESS) behind, in a second ring of summary_capacity steps
+#     - spill() writes everything currently held to a compressed .npz
+class TrajectoryHistory:
+    def __init__(self, capacity=64, max_particles=1000, summary_capacity=100000, spill_dir="."):
+        self.capacity = capacity
+        self.max_particles = max_particles
+        self.data = np.zeros((capacity, max_particles, 4), dtype=np.float32)
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.snapshot_steps = np.zeros(capacity, dtype=np.int64)
+        self.head = 0
+        self.size = 0
+        self.summary = np.zeros(summary_capacity, dtype=SUMMARY_DTYPE)
+        self.summary_head = 0
+        self.summary_size = 0
+        self.steps = 0
+        self.spill_dir = spill_dir
+
+    def __len__(self):
+        return self.steps
+
+    # Record one step. samples is a ParticleSet or a list of (x, y, theta, w).
+    def append(self, samples):
+        if not isinstance(samples, ParticleSet):
+            samples = ParticleSet.from_tuples(samples)
+        n = len(samples)
+        if n > self.max_particles:
+            keep = np.linspace(0, n - 1, self.max_particles).astype(np.intp)
+            x, y, theta, w = samples.x[keep], samples.y[keep], samples.theta[keep], samples.w[keep]
+            n = self.max_particles
+        else:
+            x, y, theta, w = samples.x, samples.y, samples.theta, samples.w
+
+        if self.size == self.capacity:
+            self._summarise_slot(self.head)
+        else:
+            self.size += 1
+        slot = self.data[self.head]
+        slot[:n, 0], slot[:n, 1], slot[:n, 2], slot[:n, 3] = x, y, theta, w
+        self.counts[self.head] = n
+        self.snapshot_steps[self.head] = self.steps
+        self.head = (self.head + 1) % self.capacity
+        self.steps += 1
+
+    def _summarise_slot(self, slot):
+        n = self.counts[slot]
+        if n == 0:
+            return
+        p = self.data[slot, :n].astype(np.float64)
+        mean, cov, ess = summarise(p[:, 0], p[:, 1], p[:, 2], p[:, 3])
+        self.summary[self.summary_head] = (self.snapshot_steps[slot], mean, cov, ess, n)
+        self.summary_head = (self.summary_head + 1) % len(self.summary)
+        self.summary_size = min(self.summary_size + 1, len(self.summary))
+
+    def _ring_order(self, head, size, capacity):
+        return (np.arange(head - size, head)) % capacity
+
+    # Full snapshots still in the ring, oldest first, as ParticleSets
+    def snapshots(self):
+        for slot in self._ring_order(self.head, self.size, self.capacity):
+            p = self.data[slot, :self.counts[slot]].astype(np.float64)
+            yield ParticleSet(p[:, 0], p[:, 1], p[:, 2], p[:, 3])
+
+    # Every particle of every full snapshot, as one (n, 4) array
+    def particles(self):
+        order = self._ring_order(self.head, self.size, self.capacity)
+        if len(order) == 0:
+            return np.empty((0, 4))
+        return np.concatenate([self.data[slot, :self.counts[slot]] for slot in order])
+
+    # Summaries of evicted steps, oldest first
+    def summaries(self):
+        return self.summary[self._ring_order(self.summary_head, self.summary_size, len(self.summary))]
+
+    def spill(self, path=None):
+        if path is None:
+            path = os.path.join(self.spill_dir, f"history-{int(time.time())}-{self.steps}.npz")
+        order = self._ring_order(self.head, self.size, self.capacity)
+        np.savez_compressed(path,
+                            data=self.data[order], counts=self.counts[order],
+                            steps=self.snapshot_steps[order], summaries=self.summaries())
+        return path
+
+    # Load a spilled file back as (snapshots, summaries) for replay
+    @staticmethod
+    def load(path):
+        with np.load(path) as f:
+            snapshots = [ParticleSet(*f["data"][i, :f["counts"][i]].T.astype(np.float64))
+                         for i in range(len(f["counts"]))]
+            return snapshots, f["summaries"]
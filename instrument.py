@@ -0,0 +1,155 @@
+import atexit
+import functools
+import json
+import math
+import os
+import sys
+import time
+
+
+# Lightweight timing spans and counters for the control loops:
+#     - with span("name"): ... and @timed("name") record the duration of
+#       a stage into a histogram (log2 buckets, in microseconds)
+#     - count("name", n) bumps a counter
+#     - everything is off unless enable() is called or ROBOT_TRACE is set;
+#       when off, span() hands back one shared no-op object, and timed
+#       functions pay a single flag check
+#     - dump() prints the aggregate, and runs at exit once enabled
+BUCKETS = 32
+
+_enabled = False
+_histograms: dict[str, "_Histogram"] = {}
+_counters: dict[str, int] = {}
+_dump_registered = False
+
+
+class _Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        micros = int(seconds * 1e6)
+        self.buckets[min(micros.bit_length(), BUCKETS - 1)] += 1
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total_s": self.total,
+            "mean_s": self.total / self.count if self.count else 0.0,
+            "min_s": self.min if self.count else 0.0,
+            "max_s": self.max,
+            # bucket i holds durations in [2^(i-1), 2^i) microseconds
+            "log2_us_buckets": self.buckets,
+        }
+
+
+def record(name, seconds):
+    hist = _histograms.get(name)
+    if hist is None:
+        hist = _histograms[name] = _Histogram()
+    hist.add(seconds)
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name):
+    return _Span(name) if _enabled else _NULL_SPAN
+
+
+def timed(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def enable(dump_on_exit=True):
+    global _enabled, _dump_registered
+    _enabled = True
+    if dump_on_exit and not _dump_registered:
+        atexit.register(dump)
+        _dump_registered = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def reset():
+    _histograms.clear()
+    _counters.clear()
+
+
+def snapshot():
+    return {
+        "spans": {name: h.as_dict() for name, h in sorted(_histograms.items())},
+        "counters": dict(sorted(_counters.items())),
+    }
+
+
+# Print the aggregate to stderr (so it does not mix with drawing output),
+# or write JSON to ROBOT_TRACE_FILE when that is set.
+def dump(file=None):
+    path = os.environ.get("ROBOT_TRACE_FILE")
+    if file is None and path:
+        with open(path, "w") as f:
+            json.dump(snapshot(), f, indent=2)
+        return
+    file = file or sys.stderr
+    print(f"{'span':<32}{'count':>8}{'total s':>12}{'mean ms':>12}{'max ms':>12}", file=file)
+    for name, h in sorted(_histograms.items()):
+        print(f"{name:<32}{h.count:>8}{h.total:>12.3f}{h.total / h.count * 1e3:>12.3f}{h.max * 1e3:>12.3f}",
+              file=file)
+    for name, value in sorted(_counters.items()):
+        print(f"{name:<32}{value:>8}", file=file)
+
+
+if os.environ.get("ROBOT_TRACE"):
+    enable()
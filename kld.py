@@ -0,0 +1,72 @@
+import math
+
+import numpy as np
+
+from resampling import systematic_indices
+
+
+# Upper standard normal quantile for 1 - delta = 0.99
+KLD_Z = 2.326
+# Sized so a localized set (about 2 cm, 0.04 rad spread) covers one or
+# two bins, where the bound drops below the minimum count
+KLD_EPSILON = 0.15
+KLD_XY_BIN = 20.0              # in cm
+KLD_THETA_BIN = math.pi / 9    # 20 degrees
+# Candidates drawn in the first round, doubling after; most localized
+# resamples stop in the first
+KLD_CHUNK = 64
+
+
+# Particles needed so that, with probability 1 - delta, the KL divergence
+# between the sampled and true posterior stays below epsilon, given the
+# posterior covers k histogram bins (Fox, KLD-sampling).
+def kld_bound(k, epsilon=KLD_EPSILON, z=KLD_Z):
+    k = np.asarray(k, dtype=np.float64)
+    a = 2 / (9 * np.maximum(k - 1, 1))
+    bound = np.ceil((k - 1) / (2 * epsilon) * (1 - a + np.sqrt(a) * z) ** 3)
+    return np.where(k > 1, bound, 1).astype(np.intp)
+
+
+def bin_keys(x, y, theta, xy_bin=KLD_XY_BIN, theta_bin=KLD_THETA_BIN):
+    ix = np.floor(x / xy_bin).astype(np.int64)
+    iy = np.floor(y / xy_bin).astype(np.int64)
+    it = np.floor((theta % (2 * math.pi)) / theta_bin).astype(np.int64)
+    # 21 bits per axis is plenty for any map we load
+    return ((ix & 0x1FFFFF) << 42) | ((iy & 0x1FFFFF) << 21) | (it & 0x1FFFFF)
+
+
+# Resample a ParticleSet to an adaptive size between min_n and max_n.
+# Candidates are drawn in growing chunks with the low-variance resampler,
+# shuffled, and taken in order until the count reaches the KLD bound for
+# the number of bins they occupy - the vectorised form of drawing one
+# particle at a time. rng (a numpy Generator) defaults to the global numpy
+# random state.
+def kld_resample(particles, min_n, max_n, resampler=systematic_indices,
+                 xy_bin=KLD_XY_BIN, theta_bin=KLD_THETA_BIN, epsilon=KLD_EPSILON, z=KLD_Z,
+                 rng=None, chunk=KLD_CHUNK):
+    rng = rng or np.random
+    taken = []
+    seen = np.empty(0, dtype=np.int64)
+    count = 0
+    while count < max_n:
+        size = min(chunk, max_n - count)
+        candidates = resampler(particles.w, size, rng)[rng.permutation(size)]
+        keys = bin_keys(particles.x[candidates], particles.y[candidates], particles.theta[candidates],
+                        xy_bin, theta_bin)
+        _, first_seen = np.unique(keys, return_index=True)
+        is_new_bin = np.zeros(size, dtype=bool)
+        is_new_bin[first_seen] = True
+        if len(seen):
+            is_new_bin &= ~np.isin(keys, seen)
+        bins_so_far = len(seen) + np.cumsum(is_new_bin)
+
+        needed = np.maximum(kld_bound(bins_so_far, epsilon, z), min_n)
+        enough = np.nonzero(count + np.arange(1, size + 1) >= needed)[0]
+        if len(enough):
+            taken.append(candidates[:enough[0] + 1])
+            break
+        taken.append(candidates)
+        seen = np.union1d(seen, keys)
+        count += size
+        chunk *= 2
+    return particles.select(np.concatenate(taken))
@@ -0,0 +1,72 @@
+import math
+
+import numpy as np
+
+from raycast import wall_table
+from sonar_lut import LUT_DIR, cached_grid, grid_axis, grid_key
+
+
+# Distance from every point of a regular grid to the nearest wall:
+#     - grid[i, j] is the Euclidean distance from (x0 + i * cm_res,
+#       y0 + j * cm_res) to the closest wall segment, computed exactly
+#       rather than from a rasterised map
+#     - the grid covers the walls' bounding box plus margin, so beam
+#       endpoints a little past a wall still land on it
+#     - cached next to the sonar lookup grids with sonar_lut.cached_grid,
+#       keyed by a hash of the walls and grid settings
+class DistanceField:
+    def __init__(self, grid, x0, y0, cm_res):
+        self.grid = grid
+        self.x0 = x0
+        self.y0 = y0
+        self.cm_res = cm_res
+
+    @staticmethod
+    def key(table, bounds, cm_res):
+        return grid_key(table, list(bounds) + [cm_res], salt=b"distance-field")
+
+    @classmethod
+    def load_or_build(cls, walls, cm_res=1.0, margin=20.0, lut_dir=LUT_DIR):
+        table = wall_table(walls)
+        x_min, x_max, y_min, y_max = table.bounds()
+        bounds = (x_min - margin, x_max + margin, y_min - margin, y_max + margin)
+        x0, x1, y0, y1 = bounds
+        shape = (int(math.ceil((x1 - x0) / cm_res)) + 1,
+                 int(math.ceil((y1 - y0) / cm_res)) + 1)
+        grid = cached_grid(lut_dir, cls.key(table, bounds, cm_res), shape,
+                           lambda g: fill_distances(g, table, x0, y0, cm_res))
+        return cls(grid, x0, y0, cm_res)
+
+    # Bilinearly interpolated distance to the nearest wall, NaN off the grid
+    def lookup(self, xs, ys):
+        nx, ny = self.grid.shape
+        fx = (np.asarray(xs, dtype=np.float64) - self.x0) / self.cm_res
+        fy = (np.asarray(ys, dtype=np.float64) - self.y0) / self.cm_res
+        fx, fy = np.broadcast_arrays(np.atleast_1d(fx), np.atleast_1d(fy))
+
+        i0, i1, dx, inside_x = grid_axis(fx, nx)
+        j0, j1, dy, inside_y = grid_axis(fy, ny)
+        inside = inside_x & inside_y
+
+        g = self.grid
+        c0 = g[i0, j0] * (1 - dy) + g[i0, j1] * dy
+        c1 = g[i1, j0] * (1 - dy) + g[i1, j1] * dy
+        out = (c0 * (1 - dx) + c1 * dx).astype(np.float64)
+        out[~inside] = np.nan
+        return out
+
+
+def fill_distances(grid, table, x0, y0, cm_res):
+    segments = table.segments()
+    px, py = segments[:, 0], segments[:, 1]
+    ex, ey = segments[:, 2] - px, segments[:, 3] - py
+    length2 = np.maximum(ex * ex + ey * ey, 1e-12)
+    nx, ny = grid.shape
+    ys = y0 + np.arange(ny) * cm_res
+    # One x column at a time keeps the working set to ny * walls
+    for i in range(nx):
+        qx = x0 + i * cm_res - px[None, :]
+        qy = ys[:, None] - py[None, :]
+        u = np.clip((qx * ex + qy * ey) / length2, 0, 1)
+        grid[i] = np.hypot(qx - u * ex, qy - u * ey).min(axis=1)
+
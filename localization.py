@@ -0,0 +1,275 @@
+import math
+from typing import *
+
+import numpy as np
+
+import maps
+import viz_sink
+from likelihood_field import DistanceField
+from particles import ParticleSet
+from raycast import PARALLEL_EPS, WallTable, cast_rays, cast_rays_incidence
+from sonar_lut import SonarLUT
+from wall_index import WallGrid
+
+
+# Map, sonar model and drawing for the localization tutorials. Importing
+# this module never touches the robot, so offline tools (benchmarks,
+# replay, map precompute) can use it without a board.
+
+SONAR_SIGMA = 2
+SONAR_GAIN = 0.05
+
+# Robust sonar model, used in log space (see robust_log_likelihoods):
+#     - a gaussian of SONAR_SIGMA around the expected range
+#     - a uniform term for random readings over [0, SONAR_MAX_RANGE]
+#     - a spike at SONAR_MAX_RANGE for echoes that never came back
+# Walls met further than SONAR_MAX_INCIDENCE from head-on reflect the beam
+# away, so they get no gaussian term.
+SONAR_MAX_RANGE = 255
+SONAR_MAX_INCIDENCE = math.radians(40)
+SONAR_Z_HIT = 0.8
+SONAR_Z_RAND = 0.15
+SONAR_Z_MAX = 0.05
+
+
+class Line:
+    def __init__(self, is_horizontal, anchor, range_min, range_max):
+        self.is_horizontal = is_horizontal
+        self.anchor = anchor
+        self.range = (min(range_min, range_max), max(range_min, range_max))
+
+    def __str__(self):
+        return f"{'y' if self.is_horizontal else 'x'} = {self.anchor}"
+
+    def distance(self, x, y, theta):
+        if self.is_horizontal:
+            # Parallel to the wall: never meets it
+            if abs(math.sin(theta)) < PARALLEL_EPS:
+                return None
+            t = (self.anchor - y) / math.sin(theta)
+            if t < 0:
+                return None
+            x_inter = x + t * math.cos(theta)
+            if self.range[0] <= x_inter <= self.range[1]:
+                coord = (x_inter, self.anchor)
+            else:
+                return None
+        else:
+            if abs(math.cos(theta)) < PARALLEL_EPS:
+                return None
+            t = (self.anchor - x) / math.cos(theta)
+            if t < 0:
+                return None
+            y_inter = y + t * math.sin(theta)
+            if self.range[0] <= y_inter <= self.range[1]:
+                coord = (self.anchor, y_inter)
+            else:
+                return None
+
+        (new_x, new_y) = coord
+        return math.sqrt((new_y - y) ** 2 + (new_x - x) ** 2)
+
+
+# The arena comes from a map file (maps/arena.json unless ROBOT_MAP says
+# otherwise); real_walls and real_wall_table are views of it. A map with
+# diagonal walls has no Line form, so real_walls is then its segments.
+arena = maps.load_map()
+real_wall_table = arena.table
+if isinstance(real_wall_table, WallTable):
+    real_walls = [Line(bool(h), a, lo, hi) for h, a, lo, hi in zip(
+        real_wall_table.is_horizontal.tolist(), real_wall_table.anchor.tolist(),
+        real_wall_table.lo.tolist(), real_wall_table.hi.tolist())]
+else:
+    real_walls = arena.draw_lines
+
+# Optional precomputed expected-range grid for real_walls, see use_sonar_lut()
+sonar_lut = None
+
+def use_sonar_lut(cm_res=1.0, angle_res=math.pi / 90):
+    global sonar_lut
+    sonar_lut = SonarLUT.load_or_build(real_wall_table, cm_res, angle_res)
+    return sonar_lut
+
+# Optional distance-to-nearest-wall grid for real_walls, used by the
+# likelihood-field model; see use_distance_field()
+distance_field = None
+
+def use_distance_field(cm_res=1.0):
+    global distance_field
+    distance_field = DistanceField.load_or_build(real_wall_table, cm_res)
+    return distance_field
+
+# Expected sonar ranges for arrays of poses, NaN where nothing is hit.
+# Reads the lookup grid when one is loaded for these walls, and walks the
+# spatial index when walls is a WallGrid (large maps).
+def expected_ranges(walls, xs, ys, thetas):
+    if sonar_lut is not None and walls is real_wall_table:
+        return sonar_lut.lookup(xs, ys, thetas)
+    if isinstance(walls, WallGrid):
+        return walls.cast_many(xs, ys, thetas)
+    return cast_rays(walls, xs, ys, thetas)
+
+# expected_ranges plus the cosine of each ray's incidence angle on the
+# wall it hits. The lookup grid only stores ranges, so with it loaded the
+# cosines are NaN (unknown, and never rejected).
+def expected_hits(walls, xs, ys, thetas):
+    if sonar_lut is not None and walls is real_wall_table:
+        ranges = sonar_lut.lookup(xs, ys, thetas)
+        return ranges, np.full(ranges.shape, np.nan)
+    if isinstance(walls, WallGrid):
+        return walls.cast_many_incidence(xs, ys, thetas)
+    return cast_rays_incidence(walls, xs, ys, thetas)
+
+# Log-likelihood of readings given expected ranges under the robust
+# mixture. Expected ranges that are NaN (nothing hit) or past the sensor's
+# reach predict a max-range reading, so no particle is dropped.
+def robust_log_likelihoods(ground_vals, cos_incidence, sonar):
+    ground_vals = np.where(np.isnan(ground_vals) | (ground_vals > SONAR_MAX_RANGE),
+                           SONAR_MAX_RANGE, ground_vals)
+    steep = cos_incidence < math.cos(SONAR_MAX_INCIDENCE)
+    log_hit = np.where(steep, -np.inf,
+                       math.log(SONAR_Z_HIT / (SONAR_SIGMA * math.sqrt(2 * math.pi)))
+                       - 0.5 * ((ground_vals - sonar) / SONAR_SIGMA) ** 2)
+    log_rand = math.log(SONAR_Z_RAND / SONAR_MAX_RANGE)
+    log_max = np.where(np.asarray(sonar) >= SONAR_MAX_RANGE, math.log(SONAR_Z_MAX), -np.inf)
+    return np.logaddexp(np.logaddexp(log_hit, log_rand), log_max)
+
+
+def calculate_likelihood(x, y, theta, sonar, walls=real_wall_table):
+    ground_val = expected_ranges(walls, x, y, theta)[0] # If NaN, the particles should be outside the walls
+    if np.isnan(ground_val):
+        return None
+    return math.exp(-0.5 * ((ground_val - sonar) / SONAR_SIGMA) ** 2) + SONAR_GAIN
+
+# Batched version of calculate_likelihood over arrays of poses.
+# Particles without a ground truth get NaN instead of None.
+def calculate_likelihoods(xs, ys, thetas, sonar, walls=real_wall_table):
+    ground_vals = expected_ranges(walls, xs, ys, thetas)
+    return np.exp(-0.5 * ((ground_vals - sonar) / SONAR_SIGMA) ** 2) + SONAR_GAIN
+
+# Several beams per particle, e.g. from a sweep or more than one sensor:
+# bearings are beam directions relative to the particle heading (radians)
+# and ranges the matching readings. All len(xs) * len(bearings) rays are
+# cast in one call, and the per-beam log-likelihoods are summed. With the
+# original model that is NaN for particles where any beam hits nothing;
+# robust=True uses robust_log_likelihoods instead.
+def beam_log_likelihoods(xs, ys, thetas, bearings, ranges, walls=real_wall_table, robust=False):
+    xs, ys, thetas = np.broadcast_arrays(np.asarray(xs, dtype=np.float64),
+                                         np.asarray(ys, dtype=np.float64),
+                                         np.asarray(thetas, dtype=np.float64))
+    bearings = np.asarray(bearings, dtype=np.float64)
+    ranges = np.asarray(ranges, dtype=np.float64)
+    beams = len(bearings)
+    ray_xs, ray_ys = np.repeat(xs, beams), np.repeat(ys, beams)
+    ray_thetas = ((thetas[:, None] + bearings) % (2 * math.pi)).ravel()
+    if robust:
+        ground_vals, cos_incidence = expected_hits(walls, ray_xs, ray_ys, ray_thetas)
+        per_beam = robust_log_likelihoods(ground_vals.reshape(len(xs), beams),
+                                          cos_incidence.reshape(len(xs), beams), ranges)
+    else:
+        ground_vals = expected_ranges(walls, ray_xs, ray_ys, ray_thetas).reshape(len(xs), beams)
+        per_beam = np.log(np.exp(-0.5 * ((ground_vals - ranges) / SONAR_SIGMA) ** 2) + SONAR_GAIN)
+    return per_beam.sum(axis=1)
+
+# Robust log-likelihoods of a single forward reading
+def sonar_log_likelihoods(xs, ys, thetas, sonar, walls=real_wall_table):
+    return beam_log_likelihoods(xs, ys, thetas, [0.0], [sonar], walls, robust=True)
+
+# Likelihood-field model, a cheaper alternative to casting the beam: the
+# reading is scored by how far its endpoint lands from the nearest wall,
+# one grid lookup per particle whatever the map. Same mixture weights as
+# the robust model; a max-range reading has no endpoint and only gets the
+# max-range and random terms. Endpoints off the grid get the random term.
+def field_log_likelihoods(xs, ys, thetas, sonar, field=None):
+    field = field or distance_field or use_distance_field()
+    xs, ys, thetas = np.broadcast_arrays(np.atleast_1d(np.asarray(xs, dtype=np.float64)),
+                                         np.atleast_1d(np.asarray(ys, dtype=np.float64)),
+                                         np.atleast_1d(np.asarray(thetas, dtype=np.float64)))
+    log_rand = math.log(SONAR_Z_RAND / SONAR_MAX_RANGE)
+    if sonar >= SONAR_MAX_RANGE:
+        return np.full(xs.shape, np.logaddexp(math.log(SONAR_Z_MAX), log_rand))
+    gaps = field.lookup(xs + sonar * np.cos(thetas), ys + sonar * np.sin(thetas))
+    log_hit = np.where(np.isnan(gaps), -np.inf,
+                       math.log(SONAR_Z_HIT / (SONAR_SIGMA * math.sqrt(2 * math.pi)))
+                       - 0.5 * (np.nan_to_num(gaps) / SONAR_SIGMA) ** 2)
+    return np.logaddexp(log_hit, log_rand)
+
+# Single-pose version, for use in place of calculate_likelihood
+def calculate_likelihood_field(x, y, theta, sonar):
+    return math.exp(field_log_likelihoods(x, y, theta, sonar)[0])
+
+# Return the sonar depth by choosing distance to the nearest wall
+def sonar_ground_truth(walls: List[Line], x: float, y: float, theta: float):
+    if isinstance(walls, WallGrid):
+        return walls.cast(x, y, theta)
+    dist = cast_rays(walls, x, y, theta)[0]
+    return None if np.isnan(dist) else float(dist)
+
+# A Canvas class for drawing a map and particles:
+#     - it takes care of a proper scaling and coordinate transformation between
+#      the map frame of reference (in cm) and the display (in pixels)
+#     - with a viz_sink.VizSink, drawing is handed to its background thread
+#      (throttled, bounded in size); without one it prints directly
+class Canvas:
+    def __init__(self,map_size=210,sink=None):
+        self.map_size    = map_size;    # in cm;
+        self.canvas_size = 768;         # in pixels;
+        self.margin      = 0.05*map_size;
+        self.scale       = self.canvas_size/(map_size+2*self.margin);
+        self.sink        = sink;
+
+    def drawLine(self,line):
+        x1 = self.__screenX(line[0]);
+        y1 = self.__screenY(line[1]);
+        x2 = self.__screenX(line[2]);
+        y2 = self.__screenY(line[3]);
+        if self.sink is not None:
+            self.sink.draw_line((x1,y1,x2,y2))
+            return
+        print("drawLine:" + str((x1,y1,x2,y2)))
+
+    def draw(self,data):
+        if self.sink is not None:
+            if not isinstance(data, ParticleSet):
+                data = ParticleSet.from_tuples(data)
+            self.sink.draw_particles(self.__screenX(data.x), self.__screenY(data.y), data.theta, data.w)
+            return
+        if isinstance(data, ParticleSet):
+            data = data.as_tuples()
+        display = [(self.__screenX(d[0]),self.__screenY(d[1])) + d[2:] for d in data];
+        print("drawParticles:" + str(display));
+
+    def __screenX(self,x):
+        return (x + self.margin)*self.scale
+
+    def __screenY(self,y):
+        return (self.map_size + self.margin - y)*self.scale
+
+# The shared canvas is only created (and its sink thread started) on first use
+canvas = None
+
+def get_canvas():
+    global canvas
+    if canvas is None:
+        canvas = Canvas(map_size=arena.size, sink=viz_sink.from_spec())
+    return canvas
+
+# A Map class containing walls
+class Map:
+    def __init__(self):
+        self.walls = [];
+
+    def add_wall(self,wall):
+        self.walls.append(wall);
+
+    def clear(self):
+        self.walls = [];
+
+    def draw(self):
+        for wall in self.walls:
+            get_canvas().drawLine(wall);
+
+def distance(pos1, pos2):
+    x1, y1 = pos1
+    x2, y2 = pos2
+    return math.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2)
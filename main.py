@@ -2,7 +2,8 @@ import time
 from dataclasses import dataclass
 from enum import Enum
 
-from brickpi3 import BrickPi3
+import instrument
+import robot_io
 
 #class Instruction(Enum):
 #    WALK_STRAIGHT = 0
@@ -11,10 +12,12 @@ from brickpi3 import BrickPi3
 
 
 
-BP = BrickPi3()
+# The real BrickPi3 unless ROBOT_IO=sim selects the simulated one,
+# opened on first use rather than at import
+BP = robot_io.RobotContext(robot_io.open_brickpi)
 
-LEFT_MOTOR_PORT = BP.PORT_C
-RIGHT_MOTOR_PORT = BP.PORT_D
+LEFT_MOTOR_PORT = robot_io.RobotIO.PORT_C
+RIGHT_MOTOR_PORT = robot_io.RobotIO.PORT_D
 
 class MoveStatus(Enum):
     WALK_STRAIGHT = 0
@@ -56,10 +59,13 @@ def main():
     
     try:
         while True:
-            time.sleep(0.1)
+            with instrument.span("main.poll_sleep"):
+                BP.sleep(0.1)
 
-            l_status = BP.get_motor_status(LEFT_MOTOR_PORT)
-            r_status = BP.get_motor_status(RIGHT_MOTOR_PORT)
+            with instrument.span("main.motor_status"):
+                l_status = BP.get_motor_status(LEFT_MOTOR_PORT)
+                r_status = BP.get_motor_status(RIGHT_MOTOR_PORT)
+            instrument.count("main.polls")
             _, _, l_mileage, _ = l_status
             _, _, r_mileage, _ = r_status
             print(l_status, r_status)
@@ -68,7 +74,8 @@ def main():
             if current_status.cms == MoveStatus.WALK_STRAIGHT:
                 if l_mileage - current_status.l_mileage_cms >= 823:
                     setStop()
-                    time.sleep(1)
+                    with instrument.span("main.corner_pause"):
+                        BP.sleep(1)
                     current_status.cms = MoveStatus.TURN_LEFT
                     current_status.l_mileage_cms = l_mileage
                     current_status.r_mileage_cms = r_mileage
@@ -77,7 +84,8 @@ def main():
             elif current_status.cms == MoveStatus.TURN_LEFT:
                 if l_mileage - current_status.l_mileage_cms >= 258:
                     setStop()
-                    time.sleep(1)
+                    with instrument.span("main.corner_pause"):
+                        BP.sleep(1)
                     current_status.cms = MoveStatus.WALK_STRAIGHT
                     current_status.l_mileage_cms = l_mileage
                     current_status.r_mileage_cms = r_mileage
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from raycast import SegmentTable, WallTable
+from wall_index import WallGrid
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MAP_DIR = os.path.join(HERE, "maps")
+MAP_CACHE_DIR = os.path.join(HERE, ".map_cache")
+DEFAULT_MAP = os.path.join(MAP_DIR, "arena.json")
+
+# Map files are JSON: a list of wall segments plus free-form metadata.
+#     {"name": "arena", "units": "cm", "size": 210,
+#      "walls": [{"label": "a", "segment": [x1, y1, x2, y2]}, ...]}
+# Everything except "walls" is kept as metadata. An optional "ray_index"
+# of "table" or "grid" overrides how the map is ray cast (see CompiledMap).
+
+# From this many segments up, rays walk a WallGrid instead of testing
+# every wall: the two break even around here (1000 rays, random segments)
+# and the grid pulls ahead quickly, about 7x at 4000 segments
+GRID_MIN_SEGMENTS = 512
+
+# Loaded maps by file hash, so every module shares one copy
+_loaded = {}
+
+
+# A map compiled once for all its users:
+#     - segments: (n, 4) float64 array of x1, y1, x2, y2 for ray casting
+#     - boxes: (n, 4) per-segment min x, min y, max x, max y; bounds is
+#       the box around the whole map
+#     - table: what the ray caster takes. A wall_index.WallGrid for maps
+#       of GRID_MIN_SEGMENTS or more (or "ray_index": "grid"), otherwise a
+#       WallTable when every wall is horizontal or vertical, else a
+#       SegmentTable
+#     - draw_lines: the segments as tuples, for Map / Canvas
+#     - labels, meta: wall names and the file's other fields
+class CompiledMap:
+    def __init__(self, segments, labels, meta):
+        self.segments = np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+        self.labels = [str(label) for label in labels]
+        self.meta = meta
+        x1, y1, x2, y2 = self.segments.T
+        self.boxes = np.stack([np.minimum(x1, x2), np.minimum(y1, y2),
+                               np.maximum(x1, x2), np.maximum(y1, y2)], axis=1)
+        if len(self.boxes):
+            self.bounds = (float(self.boxes[:, 0].min()), float(self.boxes[:, 1].min()),
+                           float(self.boxes[:, 2].max()), float(self.boxes[:, 3].max()))
+        else:
+            self.bounds = (0.0, 0.0, 0.0, 0.0)
+        index = meta.get("ray_index", "auto")
+        if index not in ("auto", "table", "grid"):
+            raise ValueError(f"unknown ray_index: {index}")
+        if index == "grid" or (index == "auto" and len(self.segments) >= GRID_MIN_SEGMENTS):
+            self.table = WallGrid([tuple(s) for s in self.segments.tolist()])
+        else:
+            self.table = axis_aligned_table(self.segments)
+            if self.table is None:
+                self.table = SegmentTable.from_segments(self.segments)
+        self.draw_lines = [tuple(s) for s in self.segments.tolist()]
+
+    def __len__(self):
+        return len(self.segments)
+
+    @property
+    def name(self):
+        return self.meta.get("name", "")
+
+    # Canvas size in map units: the "size" field, else the larger extent
+    @property
+    def size(self):
+        x0, y0, x1, y1 = self.bounds
+        return self.meta.get("size", max(x1, y1))
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, segments=self.segments, labels=np.array(self.labels, dtype=str),
+                     meta=np.array(json.dumps(self.meta)))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["segments"], f["labels"].tolist(), json.loads(str(f["meta"])))
+
+
+# WallTable for a map whose walls are all horizontal or vertical, else None
+def axis_aligned_table(segments):
+    x1, y1, x2, y2 = segments.T
+    horizontal = y1 == y2
+    if not np.all(horizontal | (x1 == x2)):
+        return None
+    return WallTable(horizontal,
+                     np.where(horizontal, y1, x1),
+                     np.where(horizontal, np.minimum(x1, x2), np.minimum(y1, y2)),
+                     np.where(horizontal, np.maximum(x1, x2), np.maximum(y1, y2)))
+
+
+def compile_map(data):
+    walls = data.get("walls", [])
+    meta = {k: v for k, v in data.items() if k != "walls"}
+    segments = [wall["segment"] for wall in walls]
+    labels = [wall.get("label", str(i)) for i, wall in enumerate(walls)]
+    for segment in segments:
+        if len(segment) != 4:
+            raise ValueError(f"wall segment needs 4 coordinates, got {segment}")
+    return CompiledMap(segments, labels, meta)
+
+
+# Load a map file, by default ROBOT_MAP or maps/arena.json. The compiled
+# form is cached on disk under the file's hash, so a map is only parsed
+# once per change, and in memory so each file is loaded once per process.
+def load_map(path=None, cache_dir=MAP_CACHE_DIR):
+    path = path or os.environ.get("ROBOT_MAP", DEFAULT_MAP)
+    with open(path, "rb") as f:
+        raw = f.read()
+    digest = hashlib.sha1(raw).hexdigest()
+    compiled = _loaded.get(digest)
+    if compiled is not None:
+        return compiled
+
+    cache_path = os.path.join(cache_dir, digest + ".npz")
+    if os.path.exists(cache_path):
+        compiled = CompiledMap.load(cache_path)
+    else:
+        compiled = compile_map(json.loads(raw))
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write under a temp name so a half-written cache is never loaded
+        tmp_path = cache_path + ".tmp"
+        compiled.save(tmp_path)
+        os.replace(tmp_path, cache_path)
+    _loaded[digest] = compiled
+    return compiled
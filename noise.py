@@ -0,0 +1,86 @@
+import os
+import queue
+import threading
+
+import numpy as np
+
+
+# Motion noise columns: distance along the heading, heading drift picked up
+# while driving, heading error from a turn
+DISTANCE, DRIFT, HEADING = range(3)
+
+
+# Seed for every noise source in a run: ROBOT_SEED when set, otherwise
+# None (fresh entropy). Runs with the same seed draw the same noise.
+def seed_from_env():
+    seed = os.environ.get("ROBOT_SEED")
+    return int(seed) if seed else None
+
+
+# Gaussian motion noise from one seeded Generator:
+#     - sigmas: standard deviation of the distance, drift and heading draws
+#     - correlation: 3x3 correlation matrix between them (identity if None)
+#     - draw(n) gives n draws of all three in one call, as three arrays
+#     - with block_size > 0 a background thread keeps up to `blocks` blocks
+#       of standard normals ready, so draw() only slices them
+# The stream of standard normals is the same with and without blocks, so a
+# seed reproduces a run exactly either way. spawn() hands out independent
+# Generators for other consumers (resampling, jitter) under the same seed.
+class NoiseSource:
+    def __init__(self, sigmas, correlation=None, seed=None, block_size=0, blocks=2):
+        sigmas = np.asarray(sigmas, dtype=np.float64)
+        correlation = np.eye(len(sigmas)) if correlation is None else np.asarray(correlation, dtype=np.float64)
+        self.sigmas = sigmas
+        self.scale = sigmas[:, None] * np.linalg.cholesky(correlation)
+        self.seed_sequence = np.random.SeedSequence(seed_from_env() if seed is None else seed)
+        self.rng = np.random.default_rng(self.seed_sequence.spawn(1)[0])
+        self.block_size = block_size
+        self.pending = np.empty((0, len(sigmas)))
+        self.blocks = None
+        self.stopped = threading.Event()
+        if block_size > 0:
+            self.blocks = queue.Queue(maxsize=blocks)
+            threading.Thread(target=self._fill, daemon=True).start()
+
+    @property
+    def seed(self):
+        return self.seed_sequence.entropy
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # The background thread owns self.rng once it is started
+    def _fill(self):
+        while not self.stopped.is_set():
+            block = self.rng.standard_normal((self.block_size, len(self.sigmas)))
+            while not self.stopped.is_set():
+                try:
+                    self.blocks.put(block, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def _standard(self, n):
+        if self.blocks is None:
+            return self.rng.standard_normal((n, len(self.sigmas)))
+        parts = [self.pending[:0]]
+        while n > 0:
+            if len(self.pending) == 0:
+                self.pending = self.blocks.get()
+            part, self.pending = self.pending[:n], self.pending[n:]
+            parts.append(part)
+            n -= len(part)
+        return np.concatenate(parts)
+
+    # (distance, drift, heading), each an array of n draws
+    def draw(self, n):
+        return tuple(self.scale @ self._standard(n).T)
+
+    def spawn(self):
+        return np.random.default_rng(self.seed_sequence.spawn(1)[0])
+
+    def close(self):
+        self.stopped.set()
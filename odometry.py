@@ -0,0 +1,72 @@
+import math
+
+import numpy as np
+
+
+# Odometry noise, as variance growing linearly with the motion so that the
+# spread after a move does not depend on how often the encoders are read.
+# Sized to roughly match tutorial4's stop-and-go errors (ES, FS).
+ODOM_FORWARD_VAR = 0.2     # cm^2 per cm travelled
+ODOM_DRIFT_VAR = 2e-5      # rad^2 per cm travelled
+ODOM_TURN_VAR = 1e-4       # rad^2 per rad turned
+
+
+# Body motion of a differential robot for wheel turns of dl, dr degrees,
+# with the tutorials' calibration: one_cm_dist degrees per cm forward and
+# pi_turn degrees per radian (left wheel forward turns left).
+def wheel_motion(dl, dr, one_cm_dist, pi_turn):
+    return (dl + dr) / 2 / one_cm_dist, (dl - dr) / 2 / pi_turn
+
+
+# Encoder-driven motion model:
+#     - propagate() reads both encoders and moves the particles by the
+#       change since the previous read, so it can be called every few
+#       milliseconds while the robot drives
+#     - each step draws forward and heading noise for all particles at
+#       once and integrates along the mid-step heading
+#     - noise comes from rng, a numpy Generator (unseeded if None)
+class Odometry:
+    def __init__(self, bp, left_port, right_port, *, one_cm_dist, pi_turn,
+                 forward_var=ODOM_FORWARD_VAR, drift_var=ODOM_DRIFT_VAR, turn_var=ODOM_TURN_VAR,
+                 rng=None):
+        self.bp = bp
+        self.left_port = left_port
+        self.right_port = right_port
+        self.one_cm_dist = one_cm_dist
+        self.pi_turn = pi_turn
+        self.forward_var = forward_var
+        self.drift_var = drift_var
+        self.turn_var = turn_var
+        self.rng = rng or np.random.default_rng()
+        self.last = None
+
+    def encoders(self):
+        return (self.bp.get_motor_status(self.left_port)[2],
+                self.bp.get_motor_status(self.right_port)[2])
+
+    # Start measuring from the current encoder readings
+    def reset(self):
+        self.last = self.encoders()
+
+    # Encoder change in degrees since the previous call (or reset)
+    def deltas(self):
+        current = self.encoders()
+        if self.last is None:
+            self.last = current
+        dl, dr = current[0] - self.last[0], current[1] - self.last[1]
+        self.last = current
+        return dl, dr
+
+    def propagate(self, particles):
+        dl, dr = self.deltas()
+        return self.apply(particles, dl, dr)
+
+    def apply(self, particles, dl, dr):
+        if dl == 0 and dr == 0:
+            return particles
+        forward, turn = wheel_motion(dl, dr, self.one_cm_dist, self.pi_turn)
+        n = len(particles)
+        forward_noise = self.rng.normal(0, math.sqrt(self.forward_var * abs(forward)), n)
+        turn_noise = self.rng.normal(
+            0, math.sqrt(self.turn_var * abs(turn) + self.drift_var * abs(forward)), n)
+        return particles.driven(forward + forward_noise, turn + turn_noise)
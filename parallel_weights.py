@@ -0,0 +1,129 @@
+import math
+import multiprocessing
+import os
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from localization import calculate_likelihoods, sonar_log_likelihoods
+from particles import ParticleSet
+
+
+# Columns of the shared particle buffer
+X, Y, THETA, W = range(4)
+COLUMNS = 4
+
+# Worker-side state: the map (sent once, at pool start) and the shared
+# buffers attached so far, by name
+_walls = None
+_attached = {}
+
+
+def _init_worker(walls):
+    global _walls
+    _walls = walls
+
+
+def _buffer(name, capacity):
+    shm = _attached.get(name)
+    if shm is None:
+        # Drop buffers the parent has replaced since
+        for old in _attached.values():
+            old.close()
+        _attached.clear()
+        shm = _attached[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray((COLUMNS, capacity), dtype=np.float64, buffer=shm.buf)
+
+
+# Weigh particles [start, end) in place. Particles outside the map get
+# weight NaN. Returns the shard's weight sum for the normaliser.
+def _weigh_shard(name, capacity, start, end, sonar):
+    data = _buffer(name, capacity)
+    likelihoods = calculate_likelihoods(data[X, start:end], data[Y, start:end],
+                                        data[THETA, start:end], sonar, walls=_walls)
+    data[W, start:end] *= likelihoods
+    return float(np.nansum(data[W, start:end]))
+
+
+# Log-space version for the robust model: W becomes the log weight, and
+# the shard returns (max, sum of exp(log weight - max)) for log-sum-exp.
+def _log_weigh_shard(name, capacity, start, end, sonar):
+    data = _buffer(name, capacity)
+    log_likelihoods = sonar_log_likelihoods(data[X, start:end], data[Y, start:end],
+                                            data[THETA, start:end], sonar, walls=_walls)
+    with np.errstate(divide="ignore"):
+        data[W, start:end] = np.log(data[W, start:end]) + log_likelihoods
+    top = float(data[W, start:end].max())
+    if not math.isfinite(top):
+        return top, 0.0
+    return top, float(np.exp(data[W, start:end] - top).sum())
+
+
+# Measurement update over a process pool. Particle arrays are copied once
+# into a shared-memory buffer; workers read their shard from it and write
+# weights back, so only (buffer name, slice, sonar value) is ever pickled.
+# The shard sums are reduced here for normalisation. With robust=True the
+# robust sonar model is used and weights are combined in log space.
+class ParallelWeigher:
+    def __init__(self, walls, processes=None, shards_per_process=2, robust=False):
+        self.robust = robust
+        self.processes = processes or os.cpu_count() or 1
+        self.shards = self.processes * shards_per_process
+        # Workers must share this process's resource tracker, so that the
+        # blocks they attach are the same registrations the parent unlinks;
+        # forked workers only do if it is running before the fork
+        resource_tracker.ensure_running()
+        self.pool = multiprocessing.Pool(self.processes, initializer=_init_worker, initargs=(walls,))
+        self.shm = None
+        self.capacity = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _ensure_capacity(self, n):
+        if n <= self.capacity:
+            return
+        self._release()
+        self.capacity = max(n, 2 * self.capacity)
+        self.shm = shared_memory.SharedMemory(create=True, size=COLUMNS * self.capacity * 8)
+
+    def _release(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    # Same result as ParticleSet.reweighted(calculate_likelihoods(...)).normalised(),
+    # or reweighted_log(sonar_log_likelihoods(...)) when robust
+    def weigh(self, particles, sonar):
+        n = len(particles)
+        self._ensure_capacity(n)
+        data = np.ndarray((COLUMNS, self.capacity), dtype=np.float64, buffer=self.shm.buf)
+        data[X, :n], data[Y, :n], data[THETA, :n], data[W, :n] = \
+            particles.x, particles.y, particles.theta, particles.w
+
+        bounds = np.linspace(0, n, self.shards + 1).astype(np.intp)
+        tasks = [(self.shm.name, self.capacity, int(a), int(b), sonar)
+                 for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+        if self.robust:
+            parts = self.pool.starmap(_log_weigh_shard, tasks)
+            top = max(t for t, _ in parts)
+            total = sum(part * math.exp(t - top) for t, part in parts if math.isfinite(t))
+            data[W, :n] = np.exp(data[W, :n] - (top + math.log(total)))
+            total = 1.0
+        else:
+            total = sum(self.pool.starmap(_weigh_shard, tasks))
+
+        w = data[W, :n]
+        keep = ~np.isnan(w)
+        result = ParticleSet(data[X, :n][keep], data[Y, :n][keep], data[THETA, :n][keep], w[keep] / total)
+        del data, w
+        return result
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self._release()
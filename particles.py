@@ -0,0 +1,124 @@
+import math
+
+import numpy as np
+
+
+TWO_PI = 2 * math.pi
+
+
+def log_sum_exp(values):
+    values = np.asarray(values, dtype=np.float64)
+    if values.size == 0:
+        return -math.inf
+    top = values.max()
+    if not np.isfinite(top):
+        return top
+    return top + math.log(np.exp(values - top).sum())
+
+
+# A particle set stored as structure-of-arrays:
+#     - x, y, theta and w each live in their own float64 buffer so motion,
+#       weighting and the pose estimate run as batched numpy operations
+#     - the old list of (x, y, theta, w) tuples is still available through
+#       as_tuples() / from_tuples() for code that walks particles one by one
+class ParticleSet:
+    def __init__(self, x, y, theta, w):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.theta = np.asarray(theta, dtype=np.float64)
+        self.w = np.asarray(w, dtype=np.float64)
+
+    @classmethod
+    def at(cls, x, y, theta, n):
+        # n identical particles sitting on one pose, uniformly weighted
+        return cls(np.full(n, x, dtype=np.float64),
+                   np.full(n, y, dtype=np.float64),
+                   np.full(n, theta, dtype=np.float64),
+                   np.full(n, 1 / n))
+
+    @classmethod
+    def from_tuples(cls, samples):
+        if len(samples) == 0:
+            return cls(np.empty(0), np.empty(0), np.empty(0), np.empty(0))
+        x, y, theta, w = np.array(samples, dtype=np.float64).T
+        return cls(x, y, theta, w)
+
+    def __len__(self):
+        return len(self.w)
+
+    def as_tuples(self):
+        return list(zip(self.x.tolist(), self.y.tolist(), self.theta.tolist(), self.w.tolist()))
+
+    def copy(self):
+        return ParticleSet(self.x.copy(), self.y.copy(), self.theta.copy(), self.w.copy())
+
+    # Motion update for a straight move of dist cm. dist_errors scale the
+    # travelled distance, angle_errors the drift picked up per cm.
+    def moved_forward(self, dist, dist_errors, angle_errors):
+        step = dist * (1 + np.asarray(dist_errors))
+        return ParticleSet(self.x + step * np.cos(self.theta),
+                           self.y + step * np.sin(self.theta),
+                           (self.theta + dist * np.asarray(angle_errors)) % TWO_PI,
+                           self.w.copy())
+
+    # Motion update for an on-the-spot left turn of turn_left_radian.
+    def turned(self, turn_left_radian, angle_errors):
+        return ParticleSet(self.x.copy(),
+                           self.y.copy(),
+                           (self.theta + turn_left_radian * (1 + np.asarray(angle_errors))) % TWO_PI,
+                           self.w.copy())
+
+    # Motion update for a short differential-drive step: forward cm along
+    # the heading halfway through a turn of `turn` radians (both per
+    # particle or scalar).
+    def driven(self, forward, turn):
+        mid = self.theta + 0.5 * np.asarray(turn)
+        return ParticleSet(self.x + forward * np.cos(mid),
+                           self.y + forward * np.sin(mid),
+                           (self.theta + turn) % TWO_PI,
+                           self.w.copy())
+
+    # Multiply weights by likelihoods; particles with a NaN likelihood
+    # (e.g. outside the map) are dropped, matching the old None handling.
+    def reweighted(self, likelihoods):
+        likelihoods = np.asarray(likelihoods, dtype=np.float64)
+        keep = ~np.isnan(likelihoods)
+        return ParticleSet(self.x[keep], self.y[keep], self.theta[keep],
+                           self.w[keep] * likelihoods[keep])
+
+    # Same, from log-likelihoods, and already normalised: the sum is done
+    # with log-sum-exp, so fusing many readings (or tiny weights) cannot
+    # underflow to all-zero weights.
+    def reweighted_log(self, log_likelihoods):
+        log_likelihoods = np.asarray(log_likelihoods, dtype=np.float64)
+        keep = ~np.isnan(log_likelihoods)
+        with np.errstate(divide="ignore"):
+            log_w = np.log(self.w[keep]) + log_likelihoods[keep]
+        return ParticleSet(self.x[keep], self.y[keep], self.theta[keep],
+                           np.exp(log_w - log_sum_exp(log_w)))
+
+    # Log of the weighted mean likelihood of a reading (the evidence), as
+    # augmented MCL tracks it; NaN particles count as likelihood zero.
+    def log_mean_likelihood(self, log_likelihoods):
+        log_likelihoods = np.asarray(log_likelihoods, dtype=np.float64)
+        keep = ~np.isnan(log_likelihoods)
+        with np.errstate(divide="ignore"):
+            return log_sum_exp(np.log(self.w[keep]) + log_likelihoods[keep]) - math.log(self.w.sum())
+
+    def normalised(self):
+        total = self.w.sum()
+        return ParticleSet(self.x, self.y, self.theta, self.w / total)
+
+    # Particles picked by index, with weights reset to uniform.
+    def select(self, indices):
+        n = len(indices)
+        return ParticleSet(self.x[indices], self.y[indices], self.theta[indices],
+                           np.full(n, 1 / n))
+
+    # Weighted mean pose; theta is averaged on the unit circle.
+    def estimate(self):
+        x = float(np.dot(self.x, self.w))
+        y = float(np.dot(self.y, self.w))
+        theta_x = float(np.dot(np.cos(self.theta), self.w))
+        theta_y = float(np.dot(np.sin(self.theta), self.w))
+        return [x, y, math.atan2(theta_y, theta_x) % TWO_PI]
@@ -0,0 +1,165 @@
+import math
+
+import instrument
+
+
+# Distance along a polyline and the nearest-point lookup used by the
+# follower. Points are (x, y) tuples in cm.
+class Path:
+    def __init__(self, points):
+        self.points = [tuple(map(float, p[:2])) for p in points]
+        self.lengths = [math.dist(a, b) for a, b in zip(self.points, self.points[1:])]
+        self.total = sum(self.lengths)
+
+    # Arc length of the point on the path nearest to (x, y), searching
+    # forward from arc length `after` so the robot never snaps back to an
+    # earlier leg that passes close by
+    def project(self, x, y, after=0.0):
+        best, best_s = math.inf, after
+        start = 0.0
+        for (ax, ay), (bx, by), length in zip(self.points, self.points[1:], self.lengths):
+            end = start + length
+            if end >= after and length > 0:
+                u = ((x - ax) * (bx - ax) + (y - ay) * (by - ay)) / length ** 2
+                u = min(max(u, (after - start) / length, 0.0), 1.0)
+                px, py = ax + u * (bx - ax), ay + u * (by - ay)
+                d = math.hypot(x - px, y - py)
+                if d < best:
+                    best, best_s = d, start + u * length
+            start = end
+        return best_s
+
+    # The point at arc length s (clamped to the ends)
+    def point_at(self, s):
+        if s <= 0 or not self.lengths:
+            return self.points[0]
+        for (ax, ay), (bx, by), length in zip(self.points, self.points[1:], self.lengths):
+            if s <= length:
+                u = s / length if length > 0 else 0.0
+                return ax + u * (bx - ax), ay + u * (by - ay)
+            s -= length
+        return self.points[-1]
+
+
+# Trapezoidal speed profile: accelerate at accel up to max_speed, and
+# brake at decel so the speed reaches zero at the end of the path.
+class TrapezoidProfile:
+    def __init__(self, max_speed, accel, decel=None):
+        self.max_speed = max_speed
+        self.accel = accel
+        self.decel = decel or accel
+        self.speed = 0.0
+
+    def next_speed(self, remaining, dt):
+        self.speed = min(self.max_speed, self.speed + self.accel * dt,
+                         math.sqrt(2 * self.decel * max(remaining, 0.0)))
+        return self.speed
+
+
+# Pure pursuit over a list of waypoints, commanding wheel speeds with
+# set_motor_dps at a fixed rate:
+#     - every tick, step() updates the pose estimate (odometry, sensing)
+#       and pose() returns it as (x, y, theta)
+#     - the goal point is `lookahead` cm further along the path than the
+#       robot's projection onto it; the arc through it sets the curvature
+#     - forward speed follows a TrapezoidProfile on the remaining path
+#       length (never below min_speed), so corners are driven through
+#       rather than stopped at
+#     - when the goal point is more than max_heading_error off the
+#       heading the robot turns on the spot first
+class PathFollower:
+    def __init__(self, bp, left_port, right_port, *, one_cm_dist, pi_turn,
+                 rate=20.0, lookahead=15.0, max_speed=12.0, accel=10.0, decel=8.0,
+                 min_speed=2.0, max_turn_rate=1.5, max_heading_error=math.pi / 3,
+                 max_wheel_dps=300, tolerance=2.0):
+        self.bp = bp
+        self.left_port = left_port
+        self.right_port = right_port
+        self.one_cm_dist = one_cm_dist
+        self.pi_turn = pi_turn
+        self.period = 1.0 / rate
+        self.lookahead = lookahead
+        self.max_speed = max_speed
+        self.accel = accel
+        self.decel = decel
+        self.min_speed = min_speed
+        self.max_turn_rate = max_turn_rate
+        self.max_heading_error = max_heading_error
+        self.max_wheel_dps = max_wheel_dps
+        self.tolerance = tolerance
+
+    # Wheel dps for forward speed v (cm/s) and turn rate omega (rad/s, left
+    # positive), scaled down together if either wheel would exceed its limit
+    def wheel_dps(self, v, omega):
+        forward = v * self.one_cm_dist
+        turn = omega * self.pi_turn
+        left, right = forward + turn, forward - turn
+        scale = max(abs(left), abs(right)) / self.max_wheel_dps
+        if scale > 1:
+            left, right = left / scale, right / scale
+        return left, right
+
+    def command(self, v, omega):
+        left, right = self.wheel_dps(v, omega)
+        self.bp.set_motor_dps(self.left_port, left)
+        self.bp.set_motor_dps(self.right_port, right)
+
+    def stop(self):
+        self.bp.set_motor_dps(self.left_port, 0)
+        self.bp.set_motor_dps(self.right_port, 0)
+
+    # Drive from the current pose through every point in waypoints, giving
+    # up after timeout seconds (by default twice the time the path takes
+    # at min_speed). Returns (reached the end, control ticks taken); the
+    # motors are stopped either way.
+    def follow(self, waypoints, pose, step, timeout=None):
+        x, y, _ = pose()
+        path = Path([(x, y)] + list(waypoints))
+        profile = TrapezoidProfile(self.max_speed, self.accel, self.decel)
+        if timeout is None:
+            timeout = 2 * path.total / self.min_speed
+        s = 0.0
+        ticks = 0
+        next_tick = self.bp.time()
+        deadline = next_tick + timeout
+        reached = False
+        try:
+            while self.bp.time() < deadline:
+                step()
+                x, y, theta = pose()
+                s = path.project(x, y, s)
+                end_x, end_y = path.points[-1]
+                remaining = path.total - s
+                if remaining <= self.tolerance and math.hypot(end_x - x, end_y - y) <= self.tolerance:
+                    reached = True
+                    break
+
+                goal_x, goal_y = path.point_at(s + self.lookahead)
+                if s + self.lookahead >= path.total:
+                    goal_x, goal_y = end_x, end_y
+                dx, dy = goal_x - x, goal_y - y
+                # Goal point in the robot frame
+                local_x = math.cos(theta) * dx + math.sin(theta) * dy
+                local_y = -math.sin(theta) * dx + math.cos(theta) * dy
+                heading_error = math.atan2(local_y, local_x)
+                if abs(heading_error) > self.max_heading_error:
+                    profile.speed = 0.0
+                    self.command(0.0, math.copysign(self.max_turn_rate, heading_error))
+                else:
+                    v = profile.next_speed(max(remaining, math.hypot(end_x - x, end_y - y)), self.period)
+                    # Creep in over the last few cm rather than stalling short
+                    v = max(v, self.min_speed)
+                    # Arc through the goal point: curvature 2 * y / L^2
+                    curvature = 2 * local_y / max(dx * dx + dy * dy, 1e-9)
+                    omega = max(-self.max_turn_rate, min(self.max_turn_rate, v * curvature))
+                    self.command(v, omega)
+
+                ticks += 1
+                instrument.count("follower.ticks")
+                next_tick += self.period
+                self.bp.sleep(max(0.0, next_tick - self.bp.time()))
+        finally:
+            self.stop()
+        if not reached:
+            instrument.count("follower.timeouts")
+        return reached, ticks
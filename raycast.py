@@ -0,0 +1,226 @@
+import numpy as np
+
+
+# Rays whose direction is this close to parallel with a wall never hit it
+# (a ray running along a wall grazes it, which a sonar does not see).
+PARALLEL_EPS = 1e-12
+# Slack on the segment parameter, so a ray through the shared corner of
+# two walls cannot slip between them on rounding
+ENDPOINT_EPS = 1e-9
+
+
+# Convert walls to (x1, y1, x2, y2) segments. Accepts axis-aligned Line
+# objects (is_horizontal, anchor, range) or plain 4-tuples.
+def wall_segments(walls):
+    segments = []
+    for wall in walls:
+        if hasattr(wall, "is_horizontal"):
+            lo, hi = wall.range
+            if wall.is_horizontal:
+                segments.append((lo, wall.anchor, hi, wall.anchor))
+            else:
+                segments.append((wall.anchor, lo, wall.anchor, hi))
+        else:
+            x1, y1, x2, y2 = wall
+            segments.append((x1, y1, x2, y2))
+    return segments
+
+
+# Upper bound on rays x walls evaluated at once, keeps temporaries small
+# when casting for 100k particles against a big map.
+CHUNK_ELEMENTS = 1 << 20
+
+
+# Flat table of axis-aligned walls, one entry per Line:
+#     - is_horizontal: wall lies on y = anchor (else x = anchor)
+#     - anchor: the fixed coordinate
+#     - lo, hi: the range covered along the other axis
+class WallTable:
+    def __init__(self, is_horizontal, anchor, lo, hi):
+        self.is_horizontal = np.asarray(is_horizontal, dtype=bool)
+        self.anchor = np.asarray(anchor, dtype=np.float64)
+        self.lo = np.asarray(lo, dtype=np.float64)
+        self.hi = np.asarray(hi, dtype=np.float64)
+
+    @classmethod
+    def from_lines(cls, walls):
+        if isinstance(walls, WallTable):
+            return walls
+        return cls([w.is_horizontal for w in walls],
+                   [w.anchor for w in walls],
+                   [w.range[0] for w in walls],
+                   [w.range[1] for w in walls])
+
+    def __len__(self):
+        return len(self.anchor)
+
+    def arrays(self):
+        return (self.is_horizontal, self.anchor, self.lo, self.hi)
+
+    # (n, 4) array of x1, y1, x2, y2
+    def segments(self):
+        h = self.is_horizontal
+        return np.stack([np.where(h, self.lo, self.anchor), np.where(h, self.anchor, self.lo),
+                         np.where(h, self.hi, self.anchor), np.where(h, self.anchor, self.hi)], axis=1)
+
+    # (x_min, x_max, y_min, y_max) over all walls
+    def bounds(self):
+        xs = np.concatenate([np.where(self.is_horizontal, self.lo, self.anchor),
+                             np.where(self.is_horizontal, self.hi, self.anchor)])
+        ys = np.concatenate([np.where(self.is_horizontal, self.anchor, self.lo),
+                             np.where(self.is_horizontal, self.anchor, self.hi)])
+        return (float(xs.min()), float(xs.max()), float(ys.min()), float(ys.max()))
+
+
+# Flat table of arbitrary segments, p + u * e for u in [0, 1]:
+#     - px, py: start point
+#     - ex, ey: vector to the end point
+class SegmentTable:
+    def __init__(self, px, py, ex, ey):
+        self.px = np.asarray(px, dtype=np.float64)
+        self.py = np.asarray(py, dtype=np.float64)
+        self.ex = np.asarray(ex, dtype=np.float64)
+        self.ey = np.asarray(ey, dtype=np.float64)
+
+    @classmethod
+    def from_segments(cls, segments):
+        segments = np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+        x1, y1, x2, y2 = segments.T
+        return cls(x1, y1, x2 - x1, y2 - y1)
+
+    def __len__(self):
+        return len(self.px)
+
+    def arrays(self):
+        return (self.px, self.py, self.ex, self.ey)
+
+    def segments(self):
+        return np.stack([self.px, self.py, self.px + self.ex, self.py + self.ey], axis=1)
+
+    def bounds(self):
+        xs = np.concatenate([self.px, self.px + self.ex])
+        ys = np.concatenate([self.py, self.py + self.ey])
+        return (float(xs.min()), float(xs.max()), float(ys.min()), float(ys.max()))
+
+
+# The table to cast against: tables and wall_index.WallGrids pass through,
+# a list of axis-aligned Lines becomes a WallTable, anything else (4-tuples,
+# mixed) a SegmentTable
+def wall_table(walls):
+    if isinstance(walls, (WallTable, SegmentTable)):
+        return walls
+    # wall_index builds on this module, so it is imported late
+    from wall_index import WallGrid
+    if isinstance(walls, WallGrid):
+        return walls
+    walls = list(walls)
+    if all(hasattr(w, "is_horizontal") for w in walls):
+        return WallTable.from_lines(walls)
+    return SegmentTable.from_segments(wall_segments(walls))
+
+
+# Distance along each ray (x, y, theta) to the nearest wall in the table.
+# Inputs broadcast to 1-D arrays; rays that hit nothing give NaN.
+def cast_rays(table, xs, ys, thetas):
+    return _cast(table, xs, ys, thetas, incidence=False)[0]
+
+
+# cast_rays plus the cosine of the angle between each ray and the normal
+# of the wall it hits (1 head-on, 0 grazing); NaN for misses.
+def cast_rays_incidence(table, xs, ys, thetas):
+    return _cast(table, xs, ys, thetas, incidence=True)
+
+
+def _cast(table, xs, ys, thetas, incidence):
+    table = wall_table(table)
+    if not isinstance(table, (WallTable, SegmentTable)):
+        # A WallGrid walks its cells one ray at a time
+        if incidence:
+            return table.cast_many_incidence(xs, ys, thetas)
+        return table.cast_many(xs, ys, thetas), None
+    kernel = _cast_segment_chunk if isinstance(table, SegmentTable) else _cast_chunk
+    xs, ys, thetas = np.broadcast_arrays(np.atleast_1d(np.asarray(xs, dtype=np.float64)),
+                                         np.atleast_1d(np.asarray(ys, dtype=np.float64)),
+                                         np.atleast_1d(np.asarray(thetas, dtype=np.float64)))
+    out = np.full(xs.shape, np.nan)
+    cos_out = np.full(xs.shape, np.nan) if incidence else None
+    if len(table) == 0 or xs.size == 0:
+        return out, cos_out
+
+    chunk = max(1, CHUNK_ELEMENTS // len(table))
+    for start in range(0, xs.size, chunk):
+        end = start + chunk
+        nearest, cos_hit = kernel(table, xs[start:end], ys[start:end], thetas[start:end], incidence)
+        out[start:end] = nearest
+        if incidence:
+            cos_out[start:end] = cos_hit
+    return out, cos_out
+
+
+def _cast_chunk(table, xs, ys, thetas, incidence=False):
+    horizontal = table.is_horizontal[None, :]
+    cos = np.cos(thetas)[:, None]
+    sin = np.sin(thetas)[:, None]
+
+    # Horizontal walls are crossed by moving along sin, vertical ones along cos.
+    toward = np.where(horizontal, sin, cos)
+    origin = np.where(horizontal, ys[:, None], xs[:, None])
+    along_origin = np.where(horizontal, xs[:, None], ys[:, None])
+    along_dir = np.where(horizontal, cos, sin)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (table.anchor[None, :] - origin) / toward
+        inter = along_origin + t * along_dir
+    # Same endpoint slack as the segment kernel, in units of wall length
+    slack = ENDPOINT_EPS * (table.hi - table.lo)[None, :]
+    hit = ((np.abs(toward) > PARALLEL_EPS) & (t >= 0)
+           & (table.lo[None, :] - slack <= inter) & (inter <= table.hi[None, :] + slack))
+
+    t = np.where(hit, t, np.inf)
+    if not incidence:
+        nearest = t.min(axis=1)
+        nearest[np.isinf(nearest)] = np.nan
+        return nearest, None
+
+    # The wall normal is the axis `toward` runs along, so |toward| is the
+    # cosine of the incidence angle
+    first = t.argmin(axis=1)[:, None]
+    nearest = np.take_along_axis(t, first, axis=1)[:, 0]
+    cos_hit = np.abs(np.take_along_axis(toward, first, axis=1))[:, 0]
+    missed = np.isinf(nearest)
+    nearest[missed] = np.nan
+    cos_hit[missed] = np.nan
+    return nearest, cos_hit
+
+
+# Ray against arbitrary segments. With q = p - o, the ray o + t * d meets
+# p + u * e where t = cross(q, e) / cross(d, e) and u = cross(q, d) / cross(d, e);
+# it is a hit for t >= 0 and u in [0, 1]. cross(d, e) is |e| times the
+# cosine of the incidence angle.
+def _cast_segment_chunk(table, xs, ys, thetas, incidence=False):
+    dx = np.cos(thetas)[:, None]
+    dy = np.sin(thetas)[:, None]
+    qx = table.px[None, :] - xs[:, None]
+    qy = table.py[None, :] - ys[:, None]
+    denom = dx * table.ey[None, :] - dy * table.ex[None, :]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (qx * table.ey[None, :] - qy * table.ex[None, :]) / denom
+        u = (qx * dy - qy * dx) / denom
+    hit = ((np.abs(denom) > PARALLEL_EPS) & (t >= 0)
+           & (u >= -ENDPOINT_EPS) & (u <= 1 + ENDPOINT_EPS))
+
+    t = np.where(hit, t, np.inf)
+    if not incidence:
+        nearest = t.min(axis=1)
+        nearest[np.isinf(nearest)] = np.nan
+        return nearest, None
+
+    first = t.argmin(axis=1)[:, None]
+    nearest = np.take_along_axis(t, first, axis=1)[:, 0]
+    length = np.hypot(table.ex, table.ey)
+    cos_hit = np.abs(np.take_along_axis(denom, first, axis=1))[:, 0] / length[first[:, 0]]
+    missed = np.isinf(nearest)
+    nearest[missed] = np.nan
+    cos_hit[missed] = np.nan
+    return nearest, cos_hit
@@ -0,0 +1,52 @@
+import math
+
+
+# Smoothing of the two averages: the fast one follows the last few
+# measurement updates, the slow one the last few dozen
+RECOVERY_ALPHA_FAST = 0.5
+RECOVERY_ALPHA_SLOW = 0.05
+# Dips of the fast average to within this fraction of the slow one are
+# the usual spread between poses and readings, not a lost robot
+RECOVERY_MIN_DIP = 0.5
+
+
+# Augmented MCL (Thrun et al., Probabilistic Robotics, 8.3.5): short and
+# long term averages of the measurement likelihood, the weighted mean of
+# the particles' likelihoods for each reading.
+#     - update() takes the log of that mean after every weighting
+#     - random_fraction() is the share of fresh uniform particles the
+#       next resample should add: 0 while the readings fit the particles,
+#       up to 1 when the fast average has collapsed against the slow one
+#       (the robot was moved, or tracking slipped off the true pose)
+#     - reset() after injecting, so one drop triggers one injection
+class LikelihoodAverages:
+    def __init__(self, alpha_fast=RECOVERY_ALPHA_FAST, alpha_slow=RECOVERY_ALPHA_SLOW,
+                 min_dip=RECOVERY_MIN_DIP):
+        self.alpha_fast = alpha_fast
+        self.alpha_slow = alpha_slow
+        self.min_dip = min_dip
+        self.reset()
+
+    def reset(self):
+        self.origin = 0.0
+        self.fast = None
+        self.slow = None
+
+    def update(self, log_mean_likelihood):
+        if not math.isfinite(log_mean_likelihood):
+            return
+        # Kept relative to the first reading since a reset, so exp() of a
+        # very unlikely reading cannot underflow the pair to zero
+        if self.fast is None:
+            self.origin = log_mean_likelihood
+            self.fast = self.slow = 1.0
+            return
+        mean = math.exp(min(log_mean_likelihood - self.origin, 50.0))
+        self.fast += self.alpha_fast * (mean - self.fast)
+        self.slow += self.alpha_slow * (mean - self.slow)
+
+    def random_fraction(self):
+        if self.fast is None:
+            return 0.0
+        fraction = 1 - self.fast / self.slow
+        return fraction if fraction > self.min_dip else 0.0
@@ -0,0 +1,52 @@
+import numpy as np
+
+
+# Resamplers: each takes normalised weights and a particle count n and
+# returns the indices of the particles that survive. rng defaults to the
+# global numpy random state.
+
+def multinomial_indices(weights, n, rng=None):
+    return _pick(weights, _uniform(rng, n))
+
+
+# One random offset, n evenly spaced pointers: lowest variance, O(N).
+def systematic_indices(weights, n, rng=None):
+    u = _uniform(rng, 1)
+    return _pick(weights, (np.arange(n) + u) / n)
+
+
+# One random pointer inside each of n equal strata.
+def stratified_indices(weights, n, rng=None):
+    return _pick(weights, (np.arange(n) + _uniform(rng, n)) / n)
+
+
+# Keep floor(n * w) copies of each particle deterministically, then fill
+# the remainder systematically from the leftover weights.
+def residual_indices(weights, n, rng=None):
+    weights = np.asarray(weights, dtype=np.float64)
+    copies = np.floor(n * weights).astype(np.intp)
+    fixed = np.repeat(np.arange(len(weights)), copies)
+    rest = n - len(fixed)
+    if rest == 0:
+        return fixed
+    residual = n * weights - copies
+    residual /= residual.sum()
+    return np.concatenate([fixed, systematic_indices(residual, rest, rng)])
+
+
+def effective_sample_size(weights):
+    weights = np.asarray(weights, dtype=np.float64)
+    return 1.0 / np.dot(weights, weights)
+
+
+def _uniform(rng, n):
+    if rng is None or rng is np.random:
+        return np.random.random_sample(n)
+    return rng.random(n)
+
+
+def _pick(weights, positions):
+    cumulative = np.cumsum(weights)
+    # Guard against the last entry landing just below 1 from rounding
+    cumulative[-1] = 1.0
+    return np.searchsorted(cumulative, positions, side="right")
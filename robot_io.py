@@ -0,0 +1,391 @@
+import asyncio
+import atexit
+import math
+import os
+import functools
+import random
+import threading
+import time
+
+from raycast import cast_rays
+
+try:
+    from brickpi3 import SensorError
+except ImportError:
+    # Bound by assignment so type checkers see one definition of the name
+    SensorError = type("SensorError", (Exception,), {})  # type: ignore[misc, assignment]
+
+
+# Robot IO interface: the subset of the BrickPi3 API the tutorials use,
+# plus a clock (time / sleep) so simulated runs need not wait in real time.
+# Port and sensor-type constants match the BrickPi3 driver.
+class RobotIO:
+    # Whether sensors may be polled from a background thread
+    threaded_sensing = True
+    # Board seconds that pass per real second, for threads that pace
+    # themselves with real-time waits
+    clock_rate = 1.0
+
+    PORT_A = 0x01
+    PORT_B = 0x02
+    PORT_C = 0x04
+    PORT_D = 0x08
+    PORT_1 = 0x01
+    PORT_2 = 0x02
+    PORT_3 = 0x04
+    PORT_4 = 0x08
+
+    class SENSOR_TYPE:
+        NONE = 1
+        NXT_ULTRASONIC = 33
+
+    def reset_all(self):
+        raise NotImplementedError
+
+    def set_sensor_type(self, port, sensor_type):
+        raise NotImplementedError
+
+    def get_sensor(self, port):
+        raise NotImplementedError
+
+    def set_motor_limits(self, port, power=0, dps=0):
+        raise NotImplementedError
+
+    def set_motor_position(self, port, position):
+        raise NotImplementedError
+
+    def set_motor_dps(self, port, dps):
+        raise NotImplementedError
+
+    def set_motor_power(self, port, power):
+        raise NotImplementedError
+
+    # Returns [flags, power, encoder (degrees), dps] like the BrickPi3
+    def get_motor_status(self, port):
+        raise NotImplementedError
+
+    def time(self):
+        raise NotImplementedError
+
+    def sleep(self, seconds):
+        raise NotImplementedError
+
+    async def sleep_async(self, seconds):
+        await asyncio.sleep(seconds)
+
+
+# The real board. brickpi3 is imported here so that only runs that
+# actually talk to the hardware need the driver installed.
+class BrickPiIO(RobotIO):
+    def __init__(self):
+        import brickpi3
+        self.bp = brickpi3.BrickPi3()
+        self.SENSOR_TYPE = self.bp.SENSOR_TYPE
+
+    def __getattr__(self, name):
+        # Anything not in the interface goes straight to the driver
+        return getattr(self.bp, name)
+
+    def reset_all(self):
+        self.bp.reset_all()
+
+    def set_sensor_type(self, port, sensor_type):
+        self.bp.set_sensor_type(port, sensor_type)
+
+    def get_sensor(self, port):
+        return self.bp.get_sensor(port)
+
+    def set_motor_limits(self, port, power=0, dps=0):
+        self.bp.set_motor_limits(port, power, dps)
+
+    def set_motor_position(self, port, position):
+        self.bp.set_motor_position(port, position)
+
+    def set_motor_dps(self, port, dps):
+        self.bp.set_motor_dps(port, dps)
+
+    def set_motor_power(self, port, power):
+        self.bp.set_motor_power(port, power)
+
+    def get_motor_status(self, port):
+        return self.bp.get_motor_status(port)
+
+    def time(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+# Simulated time. speedup is how many simulated seconds pass per real
+# second; math.inf (the default) never waits at all.
+class SimClock:
+    def __init__(self, speedup=math.inf):
+        self.now = 0.0
+        self.speedup = speedup
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        time.sleep(self.advance(seconds))
+
+    # Move simulated time on by seconds; returns the real seconds still
+    # to wait, so callers holding a lock can wait after releasing it
+    def advance(self, seconds):
+        if seconds <= 0:
+            return 0.0
+        self.now += seconds
+        return 0.0 if self.speedup == math.inf else seconds / self.speedup
+
+
+class _SimMotor:
+    # Free-running speed used when no dps limit has been set
+    MAX_DPS = 1000
+
+    def __init__(self):
+        self.encoder = 0.0
+        self.mode = "float"
+        self.target = 0.0
+        self.dps = 0.0
+        self.limit_power = 0
+        self.limit_dps = 0
+        self.speed = 0.0
+
+    def max_dps(self):
+        return self.limit_dps if self.limit_dps > 0 else self.MAX_DPS
+
+    def advance(self, dt):
+        limit = self.max_dps()
+        if self.mode == "position":
+            delta = self.target - self.encoder
+            step = max(-limit * dt, min(limit * dt, delta))
+        elif self.mode == "dps":
+            step = max(-limit, min(limit, self.dps)) * dt
+        else:
+            step = 0.0
+        self.encoder += step
+        self.speed = step / dt if dt > 0 else 0.0
+        return step
+
+
+def _locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+# A deterministic stand-in for the BrickPi3 driving a differential robot:
+#     - motors follow position / dps commands, capped by set_motor_limits
+#     - the true pose is integrated from the wheel encoders with the same
+#       one_cm_dist / pi_turn constants the tutorials use
+#     - the sonar returns the ray-cast range to walls plus gaussian noise,
+#       and raises SensorError at sonar_error_rate
+#     - every IO call costs latency seconds of simulated time
+# Runs with the same seed produce the same readings. Calls are serialised
+# with a lock so background samplers can share the board. An unthrottled
+# clock (speedup=inf) reports threaded_sensing = False: simulated time then
+# races ahead of any real-time wait, so a background sampler would see
+# almost none of it.
+class SimulatedBrickPi3(RobotIO):
+    SONAR_MAX = 255
+
+    @property
+    def threaded_sensing(self):
+        return self.clock.speedup != math.inf
+
+    @property
+    def clock_rate(self):
+        return self.clock.speedup
+
+    def __init__(self, walls=(), pose=(0.0, 0.0, 0.0), *,
+                 one_cm_dist=21, pi_turn=170,
+                 left_port=RobotIO.PORT_C, right_port=RobotIO.PORT_D,
+                 latency=0.0, speedup=math.inf, step=0.01,
+                 motion_sigma=0.0, sonar_sigma=1.0, sonar_error_rate=0.0, seed=0,
+                 sonar_bearings=None):
+        self.walls = walls
+        self.pose = list(pose)
+        self.one_cm_dist = one_cm_dist
+        self.pi_turn = pi_turn
+        self.left_port = left_port
+        self.right_port = right_port
+        self.latency = latency
+        self.clock = SimClock(speedup)
+        self.step = step
+        self.motion_sigma = motion_sigma
+        self.sonar_sigma = sonar_sigma
+        self.sonar_error_rate = sonar_error_rate
+        # Sonar port -> beam direction relative to the heading, in radians
+        self.sonar_bearings = dict(sonar_bearings or {})
+        self.rng = random.Random(seed)
+        self.motors = {}
+        self.sensors = {}
+        self.updated_at = 0.0
+        self.lock = threading.RLock()
+
+    def _motor(self, port):
+        if port not in self.motors:
+            self.motors[port] = _SimMotor()
+        return self.motors[port]
+
+    # Bring motors and pose up to the current simulated time, in small
+    # fixed steps so the integration does not depend on the call pattern
+    def _update(self):
+        while self.updated_at + self.step <= self.clock.now:
+            self.updated_at += self.step
+            steps = {port: m.advance(self.step) for port, m in self.motors.items()}
+            dl = steps.get(self.left_port, 0.0)
+            dr = steps.get(self.right_port, 0.0)
+            if dl == 0.0 and dr == 0.0:
+                continue
+            slip = 1 + self.rng.gauss(0, self.motion_sigma) if self.motion_sigma else 1
+            forward = (dl + dr) / 2 / self.one_cm_dist * slip
+            turn = (dl - dr) / 2 / self.pi_turn * slip
+            x, y, theta = self.pose
+            mid = theta + turn / 2
+            self.pose = [x + forward * math.cos(mid), y + forward * math.sin(mid),
+                         (theta + turn) % (2 * math.pi)]
+
+    def _io(self):
+        self.clock.sleep(self.latency)
+        self._update()
+
+    @_locked
+    def time(self):
+        return self.clock.time()
+
+    # The throttled real-time wait happens outside the lock, so a sampler
+    # thread can use the board meanwhile
+    def sleep(self, seconds):
+        with self.lock:
+            wait = self.clock.advance(seconds)
+            self._update()
+        time.sleep(wait)
+
+    # Advance simulated time in small steps, yielding between them so
+    # concurrent coroutines see the clock move and get to act on it
+    async def sleep_async(self, seconds):
+        deadline = self.clock.now + seconds
+        while True:
+            await asyncio.sleep(0)
+            if self.clock.now >= deadline:
+                return
+            self.sleep(min(self.step, deadline - self.clock.now))
+
+    @_locked
+    def reset_all(self):
+        self._io()
+        for m in self.motors.values():
+            m.mode = "float"
+            m.limit_power = m.limit_dps = 0
+        self.sensors = {}
+
+    @_locked
+    def set_sensor_type(self, port, sensor_type):
+        self._io()
+        self.sensors[port] = sensor_type
+
+    @_locked
+    def get_sensor(self, port):
+        self._io()
+        if self.sensors.get(port) != self.SENSOR_TYPE.NXT_ULTRASONIC:
+            raise SensorError("get_sensor error: Invalid sensor data")
+        if self.rng.random() < self.sonar_error_rate:
+            raise SensorError("get_sensor error: Invalid sensor data")
+        x, y, theta = self.pose
+        theta += self.sonar_bearings.get(port, 0.0)
+        dist = cast_rays(self.walls, x, y, theta)[0] if len(self.walls) else math.nan
+        if math.isnan(dist):
+            return self.SONAR_MAX
+        dist += self.rng.gauss(0, self.sonar_sigma)
+        return int(max(0, min(self.SONAR_MAX, round(dist))))
+
+    @_locked
+    def set_motor_limits(self, port, power=0, dps=0):
+        self._io()
+        motor = self._motor(port)
+        motor.limit_power = power
+        motor.limit_dps = dps
+
+    @_locked
+    def set_motor_position(self, port, position):
+        self._io()
+        motor = self._motor(port)
+        motor.mode = "position"
+        motor.target = position
+
+    @_locked
+    def set_motor_dps(self, port, dps):
+        self._io()
+        motor = self._motor(port)
+        motor.mode = "dps"
+        motor.dps = dps
+
+    @_locked
+    def set_motor_power(self, port, power):
+        self._io()
+        motor = self._motor(port)
+        if power == 0 or power == -128:
+            motor.mode = "float"
+        else:
+            motor.mode = "dps"
+            motor.dps = power / 100 * motor.max_dps()
+
+    @_locked
+    def get_motor_status(self, port):
+        self._io()
+        motor = self._motor(port)
+        return [0, 0, int(round(motor.encoder)), int(round(motor.speed))]
+
+
+# Lazily created robot: the board is only opened (factory() called) the
+# first time anything is asked of it, so modules can hold one at import
+# time without touching the hardware. Attribute access goes to the board.
+class RobotContext:
+    def __init__(self, factory):
+        self.factory = factory
+        self.board = None
+
+    def open(self):
+        if self.board is None:
+            self.board = self.factory()
+        return self.board
+
+    @property
+    def opened(self):
+        return self.board is not None
+
+    def __getattr__(self, name):
+        return getattr(self.open(), name)
+
+    def close(self):
+        if self.board is not None:
+            self.board.reset_all()
+            self.board = None
+
+
+# Pick a backend: "brickpi" (default), "sim" or "replay", overridable
+# with the ROBOT_IO environment variable. sim_kwargs go to
+# SimulatedBrickPi3; "replay" plays back the run log named by
+# ROBOT_REPLAY. Setting ROBOT_RECORD=PATH logs the run to PATH.
+def open_brickpi(backend=None, **sim_kwargs):
+    import runlog
+
+    backend = backend or os.environ.get("ROBOT_IO", "brickpi")
+    if backend == "sim":
+        bp = SimulatedBrickPi3(**sim_kwargs)
+    elif backend == "brickpi":
+        bp = BrickPiIO()
+    elif backend == "replay":
+        bp = runlog.LogReplayIO(os.environ["ROBOT_REPLAY"])
+    else:
+        raise ValueError(f"unknown robot IO backend: {backend}")
+
+    record_path = os.environ.get("ROBOT_RECORD")
+    if record_path:
+        bp = runlog.RecordingIO(bp, record_path)
+        atexit.register(bp.close)
+    return bp
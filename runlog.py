@@ -0,0 +1,252 @@
+import sys
+
+import numpy as np
+
+import robot_io
+
+
+# Run log: a 16 byte file header followed by fixed-width 32 byte records,
+# so a log can be memory-mapped and indexed directly.
+#     header: b"RUNLOG1\0", record size (u32), reserved (u32)
+#     record: t (f64, robot clock), kind (u8), port (u8), pad, a, b (f64)
+MAGIC = b"RUNLOG1\0"
+HEADER_SIZE = 16
+RECORD_DTYPE = np.dtype([("t", "<f8"), ("kind", "u1"), ("port", "u1"), ("pad", "V6"),
+                         ("a", "<f8"), ("b", "<f8")])
+
+# Record kinds, with what a and b hold
+MOTOR_STATUS = 1     # encoder, dps
+SENSOR = 2           # value
+SENSOR_ERROR = 3     # -
+SET_POSITION = 4     # position
+SET_DPS = 5          # dps
+SET_POWER = 6        # power
+SET_LIMITS = 7       # power, dps
+SLEEP = 8            # seconds
+RESET = 9            # -
+
+KIND_NAMES = {MOTOR_STATUS: "motor_status", SENSOR: "sensor", SENSOR_ERROR: "sensor_error",
+              SET_POSITION: "set_position", SET_DPS: "set_dps", SET_POWER: "set_power",
+              SET_LIMITS: "set_limits", SLEEP: "sleep", RESET: "reset"}
+
+
+class ReplayFinished(Exception):
+    pass
+
+
+# Append-only writer. Records are buffered and written in blocks.
+class Recorder:
+    def __init__(self, path, buffer_records=256):
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            header = MAGIC + np.array([RECORD_DTYPE.itemsize, 0], dtype="<u4").tobytes()
+            self.file.write(header)
+        self.buffer = np.zeros(buffer_records, dtype=RECORD_DTYPE)
+        self.buffered = 0
+
+    def write(self, t, kind, port=0, a=0.0, b=0.0):
+        rec = self.buffer[self.buffered]
+        rec["t"], rec["kind"], rec["port"], rec["a"], rec["b"] = t, kind, port, a, b
+        self.buffered += 1
+        if self.buffered == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer[:self.buffered].tobytes())
+        self.file.flush()
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def load(path):
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    if header[:8] != MAGIC:
+        raise ValueError(f"{path} is not a run log")
+    return np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=HEADER_SIZE)
+
+
+# Wraps another RobotIO and logs every call: encoder readings, sonar
+# values (and SensorErrors), motion commands and sleeps.
+class RecordingIO(robot_io.RobotIO):
+    # Sonar reads from a background thread would interleave with the main
+    # loop's and could not be replayed in the same order
+    threaded_sensing = False
+
+    def __init__(self, inner, path):
+        self.inner = inner
+        self.recorder = Recorder(path)
+        self.SENSOR_TYPE = inner.SENSOR_TYPE
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def _log(self, kind, port=0, a=0.0, b=0.0):
+        self.recorder.write(self.inner.time(), kind, port, a, b)
+
+    def reset_all(self):
+        self.inner.reset_all()
+        self._log(RESET)
+
+    def set_sensor_type(self, port, sensor_type):
+        self.inner.set_sensor_type(port, sensor_type)
+
+    def get_sensor(self, port):
+        try:
+            value = self.inner.get_sensor(port)
+        except robot_io.SensorError:
+            self._log(SENSOR_ERROR, port)
+            raise
+        self._log(SENSOR, port, value)
+        return value
+
+    def set_motor_limits(self, port, power=0, dps=0):
+        self.inner.set_motor_limits(port, power, dps)
+        self._log(SET_LIMITS, port, power, dps)
+
+    def set_motor_position(self, port, position):
+        self.inner.set_motor_position(port, position)
+        self._log(SET_POSITION, port, position)
+
+    def set_motor_dps(self, port, dps):
+        self.inner.set_motor_dps(port, dps)
+        self._log(SET_DPS, port, dps)
+
+    def set_motor_power(self, port, power):
+        self.inner.set_motor_power(port, power)
+        self._log(SET_POWER, port, power)
+
+    def get_motor_status(self, port):
+        status = self.inner.get_motor_status(port)
+        self._log(MOTOR_STATUS, port, status[2], status[3])
+        return status
+
+    def time(self):
+        return self.inner.time()
+
+    def sleep(self, seconds):
+        self._log(SLEEP, 0, seconds)
+        self.inner.sleep(seconds)
+
+    async def sleep_async(self, seconds):
+        self._log(SLEEP, 0, seconds)
+        await self.inner.sleep_async(seconds)
+
+    def close(self):
+        self.recorder.close()
+
+
+# Serves a recorded run back through the RobotIO interface with no
+# waiting: each encoder or sonar query returns the next recorded reading
+# for that port (recorded SensorErrors are raised again), commands are
+# accepted and ignored, and time() follows the log. The code under test
+# must make the same sequence of queries as the recorded run;
+# ReplayFinished is raised once the log runs out. Runs that would not
+# ask in the same order can still be replayed with open_loop_events.
+class LogReplayIO(robot_io.RobotIO):
+    threaded_sensing = False
+
+    def __init__(self, path):
+        self.records = load(path)
+        self.now = float(self.records["t"][0]) if len(self.records) else 0.0
+        self.cursors = {}
+        # Per (kind, port): indices of matching records, in order
+        self.index = {}
+        kinds = np.asarray(self.records["kind"])
+        ports = np.asarray(self.records["port"])
+        for port in np.unique(ports[kinds == MOTOR_STATUS]):
+            self.index[(MOTOR_STATUS, int(port))] = np.nonzero((kinds == MOTOR_STATUS) & (ports == port))[0]
+        sonar = (kinds == SENSOR) | (kinds == SENSOR_ERROR)
+        for port in np.unique(ports[sonar]):
+            self.index[(SENSOR, int(port))] = np.nonzero(sonar & (ports == port))[0]
+
+    def _next(self, kind, port):
+        key = (kind, port)
+        rows = self.index.get(key)
+        cursor = self.cursors.get(key, 0)
+        if rows is None or cursor >= len(rows):
+            raise ReplayFinished(f"no more {KIND_NAMES[kind]} records for port {port} "
+                                 f"(replay at t={self.now:.3f}, {cursor} of them used)")
+        self.cursors[key] = cursor + 1
+        rec = self.records[rows[cursor]]
+        self.now = max(self.now, float(rec["t"]))
+        return rec
+
+    def reset_all(self):
+        pass
+
+    def set_sensor_type(self, port, sensor_type):
+        pass
+
+    def get_sensor(self, port):
+        rec = self._next(SENSOR, port)
+        if rec["kind"] == SENSOR_ERROR:
+            raise robot_io.SensorError("get_sensor error: recorded sensor error")
+        return int(rec["a"]) if float(rec["a"]).is_integer() else float(rec["a"])
+
+    def set_motor_limits(self, port, power=0, dps=0):
+        pass
+
+    def set_motor_position(self, port, position):
+        pass
+
+    def set_motor_dps(self, port, dps):
+        pass
+
+    def set_motor_power(self, port, power):
+        pass
+
+    def get_motor_status(self, port):
+        rec = self._next(MOTOR_STATUS, port)
+        return [0, 0, int(rec["a"]), int(rec["b"])]
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        pass
+
+    async def sleep_async(self, seconds):
+        pass
+
+
+# A recorded run as the filter sees it, in time order and open loop (the
+# code replaying it may ask for nothing in particular):
+#     ("move", t, dl, dr): wheel turns in degrees since the previous move,
+#         given just before the first sonar reading after the wheels turned
+#     ("sonar", t, value): one reading from sonar_port
+# The final move is given at the end of the log. Sensor errors are skipped.
+def open_loop_events(records, left_port, right_port, sonar_port):
+    encoders = {}
+    last = None
+    for rec in records:
+        kind, port = int(rec["kind"]), int(rec["port"])
+        if kind == MOTOR_STATUS:
+            encoders[port] = float(rec["a"])
+        elif kind == SENSOR and port == sonar_port:
+            current = (encoders.get(left_port), encoders.get(right_port))
+            if None not in current:
+                if last is not None and current != last:
+                    yield "move", float(rec["t"]), current[0] - last[0], current[1] - last[1]
+                last = current
+            yield "sonar", float(rec["t"]), float(rec["a"])
+    current = (encoders.get(left_port), encoders.get(right_port))
+    if last is not None and None not in current and current != last:
+        yield "move", float(records["t"][-1]), current[0] - last[0], current[1] - last[1]
+
+
+# Print a log as text: python runlog.py dump LOG
+def dump(path):
+    for rec in load(path):
+        print(f"{rec['t']:12.3f} {KIND_NAMES.get(int(rec['kind']), rec['kind']):>13} "
+              f"port={rec['port']} a={rec['a']:g} b={rec['b']:g}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "dump":
+        dump(sys.argv[2])
+    else:
+        print("usage: python runlog.py dump LOG")
@@ -0,0 +1,125 @@
+import hashlib
+import math
+import os
+
+import numpy as np
+
+from raycast import cast_rays, wall_table
+
+
+TWO_PI = 2 * math.pi
+# Revision of raycast's kernels the cached range grids were built with
+RAY_KERNEL_REVISION = b"endpoint-slack"
+LUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".sonar_lut")
+
+
+# Precomputed expected sonar range on a regular (x, y, theta) grid:
+#     - grid[i, j, k] is the ray-cast distance from
+#       (x0 + i * cm_res, y0 + j * cm_res, k * angle_res), NaN if nothing is hit
+#     - lookup() interpolates trilinearly, wrapping around in theta
+#     - the grid is stored as a .npy file keyed by a hash of the walls and
+#       grid settings, and memory-mapped on load
+class SonarLUT:
+    def __init__(self, grid, x0, y0, cm_res):
+        self.grid = grid
+        self.x0 = x0
+        self.y0 = y0
+        self.cm_res = cm_res
+        self.angle_res = TWO_PI / grid.shape[2]
+
+    # Salted with the ray kernel's revision: bump it whenever cast_rays
+    # changes what it returns, so older grids are rebuilt
+    @staticmethod
+    def key(table, bounds, cm_res, angle_count):
+        return grid_key(table, list(bounds) + [cm_res, angle_count], salt=RAY_KERNEL_REVISION)
+
+    @classmethod
+    def load_or_build(cls, walls, cm_res=1.0, angle_res=math.pi / 90, bounds=None, lut_dir=LUT_DIR):
+        table = wall_table(walls)
+        if bounds is None:
+            bounds = wall_bounds(table)
+        x0, x1, y0, y1 = bounds
+        angle_count = max(1, int(round(TWO_PI / angle_res)))
+        shape = (int(math.ceil((x1 - x0) / cm_res)) + 1,
+                 int(math.ceil((y1 - y0) / cm_res)) + 1,
+                 angle_count)
+        grid = cached_grid(lut_dir, cls.key(table, bounds, cm_res, angle_count), shape,
+                           lambda g: fill_grid(g, table, x0, y0, cm_res))
+        return cls(grid, x0, y0, cm_res)
+
+    # Interpolated expected range for arrays of poses, NaN outside the grid
+    # or next to cells where the ray misses every wall.
+    def lookup(self, xs, ys, thetas):
+        nx, ny, nt = self.grid.shape
+        fx = (np.asarray(xs, dtype=np.float64) - self.x0) / self.cm_res
+        fy = (np.asarray(ys, dtype=np.float64) - self.y0) / self.cm_res
+        ft = (np.asarray(thetas, dtype=np.float64) % TWO_PI) / self.angle_res
+        fx, fy, ft = np.broadcast_arrays(np.atleast_1d(fx), np.atleast_1d(fy), np.atleast_1d(ft))
+
+        i0, i1, dx, inside_x = grid_axis(fx, nx)
+        j0, j1, dy, inside_y = grid_axis(fy, ny)
+        inside = inside_x & inside_y
+        k0 = np.floor(ft).astype(np.intp) % nt
+        k1 = (k0 + 1) % nt
+        dt = ft - np.floor(ft)
+
+        g = self.grid
+        c00 = g[i0, j0, k0] * (1 - dt) + g[i0, j0, k1] * dt
+        c01 = g[i0, j1, k0] * (1 - dt) + g[i0, j1, k1] * dt
+        c10 = g[i1, j0, k0] * (1 - dt) + g[i1, j0, k1] * dt
+        c11 = g[i1, j1, k0] * (1 - dt) + g[i1, j1, k1] * dt
+        c0 = c00 * (1 - dy) + c01 * dy
+        c1 = c10 * (1 - dy) + c11 * dy
+        out = (c0 * (1 - dx) + c1 * dx).astype(np.float64)
+        out[~inside] = np.nan
+        return out
+
+
+# Cache key for a grid computed from a wall table: a hash of the walls and
+# the grid settings (a list of numbers), with salt telling kinds of grid apart
+def grid_key(table, settings, salt=b""):
+    h = hashlib.sha1(salt)
+    for arr in table.arrays():
+        h.update(np.ascontiguousarray(arr).tobytes())
+    h.update(np.array(settings, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+# The float32 grid stored as <lut_dir>/<key>.npy, memory-mapped read-only.
+# If it is missing, it is created with the given shape and filled in place
+# by fill(grid) first.
+def cached_grid(lut_dir, key, shape, fill):
+    path = os.path.join(lut_dir, key + ".npy")
+    if not os.path.exists(path):
+        os.makedirs(lut_dir, exist_ok=True)
+        # Write to a temp name first so a crashed build never gets loaded
+        tmp_path = path + ".tmp"
+        grid = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=shape)
+        fill(grid)
+        grid.flush()
+        del grid
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode="r")
+
+
+# Linear interpolation along one grid axis of n cells, for fractional cell
+# coordinates f: lower and upper cell index, the weight of the upper one,
+# and whether f lies on the grid at all
+def grid_axis(f, n):
+    i0 = np.clip(np.floor(f).astype(np.intp), 0, max(n - 2, 0))
+    i1 = np.minimum(i0 + 1, n - 1)
+    return i0, i1, np.clip(f - i0, 0, 1), (f >= 0) & (f <= n - 1)
+
+
+def wall_bounds(table):
+    return wall_table(table).bounds()
+
+
+def fill_grid(grid, table, x0, y0, cm_res):
+    nx, ny, nt = grid.shape
+    ys = y0 + np.arange(ny) * cm_res
+    thetas = np.arange(nt) * (TWO_PI / nt)
+    yy, tt = np.meshgrid(ys, thetas, indexing="ij")
+    # One x column at a time keeps the working set to ny * nt rays
+    for i in range(nx):
+        grid[i] = cast_rays(table, x0 + i * cm_res, yy.ravel(), tt.ravel()).reshape(ny, nt)
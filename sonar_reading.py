@@ -2,15 +2,19 @@ from __future__ import print_function # use python 3 syntax but make it compatib
 from __future__ import division       #                           ''
 
 import time     # import the time library for the sleep function
-import brickpi3 # import the BrickPi3 drivers
+import robot_io # BrickPi3 (or simulated) board, opened on first use
 
 # Constants
-BP = brickpi3.BrickPi3()
-SONAR_PORT = BP.PORT_4
-BP.reset_all()
+SONAR_PORT = robot_io.RobotIO.PORT_4
 
 # BP Setting
-BP.set_sensor_type(SONAR_PORT, BP.SENSOR_TYPE.NXT_ULTRASONIC)
+def open_board():
+    bp = robot_io.open_brickpi()
+    bp.reset_all()
+    bp.set_sensor_type(SONAR_PORT, bp.SENSOR_TYPE.NXT_ULTRASONIC)
+    return bp
+
+BP = robot_io.RobotContext(open_board)
 
 def continuous_output():
     time.sleep(5)
@@ -23,7 +27,7 @@ def continuous_output():
             try:
                 value = BP.get_sensor(SONAR_PORT)
                 print("Distance: ", value)                         # print the distance in CM
-            except brickpi3.SensorError as error:
+            except robot_io.SensorError as error:
                 print(error)
             
             time.sleep(1)  # delay for 0.02 seconds (20ms) to reduce the Raspberry Pi CPU load.
@@ -32,4 +36,5 @@ def continuous_output():
             BP.reset_all()        # Unconfigure the sensors, disable the motors, and restore the LED to the control of the BrickPi3 firmware.
 
 
-continuous_output()
+if __name__ == "__main__":
+    continuous_output()
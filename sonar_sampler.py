@@ -0,0 +1,117 @@
+import threading
+
+import numpy as np
+
+import instrument
+import robot_io
+
+
+# Reads the sonar continuously in a background thread:
+#     - readings go into a fixed-size ring of (timestamp, value) with
+#       timestamps from bp.time(), so they line up with the robot clock
+#     - queries (median since t, nearest to t, latest) never touch the
+#       sensor, they only look at the ring
+#     - SensorErrors are counted in error_count instead of printed
+#     - readings are paced at rate per second of board time, via the
+#       board's clock_rate
+class SonarSampler:
+    def __init__(self, bp, port, rate=20.0, capacity=256):
+        self.bp = bp
+        self.port = port
+        self.period = 1.0 / rate
+        self.times = np.full(capacity, np.nan)
+        self.values = np.full(capacity, np.nan)
+        self.head = 0          # next slot to write
+        self.total = 0         # readings ever written
+        self.error_count = 0
+        self.lock = threading.Condition()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="sonar-sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            self.sample_once()
+            self.stop_event.wait(self.period / getattr(self.bp, "clock_rate", 1.0))
+
+    # Take one reading now; also usable without the thread
+    def sample_once(self):
+        try:
+            value = self.bp.get_sensor(self.port)
+        except robot_io.SensorError:
+            with self.lock:
+                self.error_count += 1
+            instrument.count("sonar.sensor_error")
+            return
+        self.push(self.bp.time(), value)
+
+    def push(self, timestamp, value):
+        with self.lock:
+            self.times[self.head] = timestamp
+            self.values[self.head] = value
+            self.head = (self.head + 1) % len(self.times)
+            self.total += 1
+            self.lock.notify_all()
+
+    # The stored readings, oldest first, as (times, values) copies
+    def snapshot(self):
+        with self.lock:
+            n = min(self.total, len(self.times))
+            order = (np.arange(self.head - n, self.head)) % len(self.times)
+            return self.times[order], self.values[order]
+
+    # Median of the last n readings taken at or after since. Returns None
+    # when there are fewer than min_count such readings.
+    def median(self, n=11, since=None, min_count=1):
+        times, values = self.snapshot()
+        if since is not None:
+            values = values[times >= since]
+        values = values[-n:]
+        if len(values) < max(min_count, 1):
+            return None
+        return float(np.median(values))
+
+    # (timestamp, value) of the reading closest to timestamp, or None
+    def nearest(self, timestamp):
+        times, values = self.snapshot()
+        if len(times) == 0:
+            return None
+        i = int(np.argmin(np.abs(times - timestamp)))
+        return float(times[i]), float(values[i])
+
+    def latest(self):
+        times, values = self.snapshot()
+        if len(times) == 0:
+            return None
+        return float(times[-1]), float(values[-1])
+
+    def count_since(self, since):
+        times, _ = self.snapshot()
+        return int(np.count_nonzero(times >= since))
+
+    # Block until count readings at or after since are stored, or timeout
+    # real seconds pass. Returns whether they arrived.
+    def wait_for(self, count, since, timeout):
+        with self.lock:
+            return self.lock.wait_for(
+                lambda: np.count_nonzero(self.times >= since) >= count, timeout)
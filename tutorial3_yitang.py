@@ -1,11 +1,16 @@
 import time
 from dataclasses import dataclass
 from enum import Enum
-import random
 import math
 
 from brickpi3 import BrickPi3
 
+import viz_sink
+from history import TrajectoryHistory
+from noise import NoiseSource
+import instrument
+from instrument import timed
+
 
 
 BP = BrickPi3()
@@ -21,12 +26,15 @@ GS = 0.02
 
 nav_points = [(10, 0), (20, 0), (30, 0), (40, 0), (40, 10), (40, 20), (40, 30), (40, 40), (30, 40), (20, 40), (10, 40), (0, 40), (0, 30), (0, 20), (0, 10), (0, 0)]
 
-def gausses(sigma):
-    return [random.gauss(0, sigma) for _ in range(SAMPLE_SIZE)]
+# Distance, drift and heading noise for all samples in one draw; seeded
+# from ROBOT_SEED when set
+NOISE = NoiseSource((ES, FS, GS))
+
 
+viz = viz_sink.from_spec()
 
 def trans_coord(pos):
-    x, y, theta = pos
+    x, y, theta = pos[:3]
     return (x * 10 + 100, 500 - y * 10, theta)
 
 def distance(pos1, pos2):
@@ -78,7 +86,8 @@ class Robot:
         self.round = 0
         self.step = 0
         self.samples = [(0, 0, 0, 1 / SAMPLE_SIZE) for _ in range(SAMPLE_SIZE)]
-        self.history = self.samples
+        self.history = TrajectoryHistory()
+        self.history.append(self.samples)
         
     def cur_pos(self):
         x = 0
@@ -101,6 +110,7 @@ class Robot:
         self.go_straight_dist(distance((cur_x, cur_y), (x, y)))
         print(theta, angle, dtheta)
 
+    @timed("robot.go_straight")
     def go_straight_dist(self, dist=10):
         try:
             while True:
@@ -118,16 +128,16 @@ class Robot:
                 else:
                     setWalkStraight()
                 
+                instrument.count("robot.motor_polls")
                 time.sleep(0.02)
             
-            dist_error_by_xy = gausses(ES)
-            dist_error_by_theta = gausses(FS)
+            dist_error_by_xy, dist_error_by_theta, _ = NOISE.draw(len(self.samples))
             self.samples = [
                     new_sample_go_straight(s, d, a, dist) 
                     for s, d, a in 
                     zip(self.samples, dist_error_by_xy, dist_error_by_theta)
                 ]
-            self.history += self.samples
+            self.history.append(self.samples)
             self.draw()
         except Exception as e:
             print(e)
@@ -135,6 +145,7 @@ class Robot:
         except KeyboardInterrupt:
             setStop()
     
+    @timed("robot.turn")
     def turn(self, angle_rad=0.5):
         try:
             while True:
@@ -161,24 +172,27 @@ class Robot:
                     else:
                         setTurnRight()
 
+                instrument.count("robot.motor_polls")
                 time.sleep(0.02)
             
             # better version of turn_one
-            angle_errors = gausses(GS)
+            _, _, angle_errors = NOISE.draw(len(self.samples))
             self.samples = [
                 new_samples_turn(p, g, angle_rad) 
                 for p, g in 
                 zip(self.samples, angle_errors)
             ]
-            self.history += self.samples
+            self.history.append(self.samples)
         except Exception as e:
             print(e)
             setStop()
         except KeyboardInterrupt:
             setStop()
 
+    @timed("robot.draw")
     def draw(self):
-        print("drawParticles:" + str([trans_coord(pos) for pos in self.history]))
+        x, y, theta, _ = self.history.particles().T
+        viz.draw_particles(x * 10 + 100, 500 - y * 10, theta)
 
 
 
@@ -1,3 +1,7 @@
+import asyncio
+import atexit
+import os
+import sys
 import time
 from dataclasses import dataclass
 from enum import Enum
@@ -5,32 +9,132 @@ import random
 import math
 from typing import *
 
-from brickpi3 import BrickPi3
-import brickpi3  # import the BrickPi3 drivers
+import numpy as np
+
+import robot_io
+import runlog
+from async_motion import AsyncMotion
+from odometry import Odometry
+from path_follower import PathFollower
+from global_localization import OccupancyRaster, converged
+from sonar_sampler import SonarSampler
+from history import TrajectoryHistory
+import instrument
+from instrument import timed
+from particles import ParticleSet
+from localization import (
+    SONAR_SIGMA, SONAR_GAIN, Line, arena, real_walls, real_wall_table, use_sonar_lut, expected_ranges,
+    calculate_likelihood, calculate_likelihoods, beam_log_likelihoods, sonar_log_likelihoods,
+    field_log_likelihoods, sonar_ground_truth, Canvas, Map, get_canvas, distance)
+from resampling import systematic_indices, effective_sample_size
+from kld import kld_resample
+from recovery import LikelihoodAverages
+from noise import NoiseSource
 
 from typing import *
 
 
-BP = BrickPi3()
-
-LEFT_MOTOR_PORT = BP.PORT_C
-RIGHT_MOTOR_PORT = BP.PORT_D
-SONAR_PORT = BP.PORT_4
-BP.reset_all()
 ONE_CM_DIST = 21
 PI_TURN = 170
 SAMPLE_SIZE = 114
 ES = 0.1
 FS = 0.001
 GS = 0.08
-SONAR_SIGMA = 2
-SONAR_GAIN = 0.05
+# Motion noise sigmas for (distance, drift, heading); turns use FS like
+# the drift. Correlation None keeps the three independent. The seed comes
+# from ROBOT_SEED when set, so a seeded run (or replay) draws the same noise.
+MOTION_SIGMAS = (ES, FS, FS)
+MOTION_CORRELATION = None
+# Pre-generate noise this many draws at a time in the background (0: off)
+NOISE_BLOCK_SIZE = 0
+# Resample only once the effective sample size drops below this
+# fraction of the particle count
+RESAMPLE_ESS_RATIO = 0.5
+# Any of resampling.{systematic,stratified,residual,multinomial}_indices
+RESAMPLER = systematic_indices
+# KLD-sampling: resampling picks the particle count between these limits,
+# more while the posterior is spread out, fewer once it has converged.
+# SAMPLE_SIZE is then only the starting count.
+ADAPTIVE_SAMPLE_SIZE = True
+KLD_MIN_SAMPLES = 30
+KLD_MAX_SAMPLES = 5000
+# Kidnap recovery (augmented MCL, see recovery.py): when the readings stop
+# fitting the particles, the next resample adds up to RECOVERY_SAMPLES
+# particles spread over free space, and KLD-sampling keeps the bigger set
+# while it is spread out. One forward reading fits too many poses to pick
+# the right one while driving on, so to_point and to_point_driving then
+# stop and localize globally (turning on the spot) before going on
+KIDNAP_RECOVERY = True
+RECOVERY_SAMPLES = 2000
+# Background sonar sampling: readings per second, and how many fresh
+# readings after the robot stops are enough for accurate_sonar_read
+USE_SONAR_SAMPLER = True
+SONAR_SAMPLE_RATE = 20
+SONAR_MIN_READINGS = 5
+SONAR_WAIT_TIMEOUT = 1.0
+# Weigh in log space with the robust sonar mixture (hit / random / max
+# range, steep-incidence rejection) instead of calculate_likelihood
+ROBUST_SONAR_MODEL = True
+# Score readings with the likelihood field (nearest-wall distance of the
+# beam endpoint, one grid lookup per particle) instead of casting the beam
+USE_LIKELIHOOD_FIELD = False
+# Track while driving: particles follow the encoders every ODOMETRY_PERIOD
+# seconds and take a single sonar reading every DRIVING_SENSE_PERIOD, so
+# to_point_driving needs no stops to localize. Off by default: only tried
+# on the simulator so far; the stop-and-go to_point stays the default
+TRACK_WHILE_DRIVING = False
+ODOMETRY_PERIOD = 0.02
+DRIVING_SENSE_PERIOD = 0.25
+# Drive the whole of nav_points with the pure pursuit follower (fixed-rate
+# set_motor_dps control on the tracked pose) instead of point to point.
+# Off by default, like TRACK_WHILE_DRIVING
+FOLLOW_PATH = False
+FOLLOW_RATE = 20
+# Give up on the path (motors stopped) after this many seconds; None
+# allows twice the time the path takes at the follower's minimum speed
+FOLLOW_TIMEOUT = 120
+# Global localization: start from GLOBAL_SAMPLE_SIZE particles spread over
+# the free space of the map instead of at (SX, SY), turning on the spot by
+# GLOBAL_TURN between sonar updates. Once the spread stays under the
+# GLOBAL_CONVERGED_* limits for GLOBAL_CONVERGED_STEPS updates the set is
+# cut down to SAMPLE_SIZE and normal tracking takes over. Convergence only
+# counts after a full turn (one reading is ambiguous), and each resample
+# swaps GLOBAL_RANDOM_FRACTION of the set for fresh uniform particles so a
+# wrong early guess can still be undone.
+# A turn on one spot cannot tell the start from its look-alikes (the
+# arena maps onto itself turned 90 degrees about (84, 84) near the start),
+# so the first pose it settles on is checked: drive up to GLOBAL_CHECK_DIST
+# (keeping GLOBAL_CHECK_CLEARANCE from the wall ahead), turn again, and
+# accept once it settles with at most GLOBAL_CHECK_MISFITS readings off
+# the range the pose predicts by more than GLOBAL_MISFIT_RANGE, plus what a
+# heading error of GLOBAL_CONVERGED_THETA makes of that range. A failed
+# check spreads the set over the map again.
+GLOBAL_LOCALIZATION = False
+GLOBAL_SAMPLE_SIZE = 5000
+GLOBAL_TURN = math.pi / 4
+GLOBAL_MAX_STEPS = 96
+GLOBAL_CONVERGED_XY = 8.0
+GLOBAL_CONVERGED_THETA = 0.15
+GLOBAL_CONVERGED_STEPS = 3
+GLOBAL_RANDOM_FRACTION = 0.05
+GLOBAL_CHECK_DIST = 30
+GLOBAL_CHECK_CLEARANCE = 20
+GLOBAL_CHECK_MISFITS = 1
+GLOBAL_MISFIT_RANGE = 10
+# While global, log-likelihoods are scaled by GLOBAL_TEMPER, rising to 1
+# over the first turn (a wider sonar model to start with: the set is too
+# sparse for any particle to sit within SONAR_SIGMA of the truth), and
+# resampled particles are jittered by GLOBAL_JITTER_*
+GLOBAL_TEMPER = 0.25
+GLOBAL_JITTER_XY = 1.5
+GLOBAL_JITTER_THETA = 0.05
+# Measurement updates for at least this many particles go to the process
+# pool set up by Robot.use_parallel_weighting()
+PARALLEL_MIN_PARTICLES = 50000
 
 SX = 84
 SY = 30
 
-BP.set_sensor_type(SONAR_PORT, BP.SENSOR_TYPE.NXT_ULTRASONIC)
-
 nav_points = [(180, 30), (180, 54), (138, 54), (138, 168),
               (114, 168), (114, 84), (84, 84), (84, 30)]
 # nav_points = [(180, 30)]
@@ -39,116 +143,30 @@ def my_print(*args, **kwargs):
     print(*args, **kwargs, flush=True)
 
 
-class Line:
-    def __init__(self, is_horizontal, anchor, range_min, range_max):
-        self.is_horizontal = is_horizontal
-        self.anchor = anchor
-        self.range = (min(range_min, range_max), max(range_min, range_max))
-
-    def __str__(self):
-        return f"{'y' if self.is_horizontal else 'x'} = {self.anchor}"
-
-    def distance(self, x, y, theta):
-        if self.is_horizontal:
-            if theta == 0.0 or theta == 1.0:
-                return None
-            t = (self.anchor - y) / math.sin(theta)
-            if t < 0:
-                return None
-            x_inter = x + t * math.cos(theta)
-            if self.range[0] <= x_inter <= self.range[1]:
-                coord = (x_inter, self.anchor)
-            else:
-                return None
-        else:
-            if theta == 0.5 or theta == 1.5:
-                return None
-            t = (self.anchor - x) / math.cos(theta)
-            if t < 0:
-                return None
-            y_inter = y + t * math.sin(theta)
-            if self.range[0] <= y_inter <= self.range[1]:
-                coord = (self.anchor, y_inter)
-            else:
-                return None
-
-        (new_x, new_y) = coord
-        return math.sqrt((new_y - y) ** 2 + (new_x - x) ** 2)
-
-
-real_walls = [Line(False, 0, 0, 168), Line(True, 168, 0, 84), Line(False, 84, 126, 210), Line(
-    True, 210, 84, 168), Line(False, 168, 84, 210), Line(True, 84, 168, 210), Line(False, 210, 0, 84), Line(True, 0, 0, 210)]
-# real_walls = [Line(False, 184, 0, 168)]
-
-
-def calculate_likelihood(x, y, theta, sonar, walls=real_walls):
-    ground_val = sonar_ground_truth(walls, x, y, theta) # If None, the particles should be outside the walls
-    if ground_val is None:
-        return None
-    return math.exp(-0.5 * ((ground_val - sonar) / SONAR_SIGMA) ** 2) + SONAR_GAIN
-
-# Return the sonar depth by choosing distance to the nearest wall
-def sonar_ground_truth(walls: List[Line], x: float, y: float, theta: float):
-    try:
-        return min(filter(lambda x: x is not None, [wall.distance(x, y, theta) for wall in walls]))
-    except:
-        return None
-
-# A Canvas class for drawing a map and particles:
-#     - it takes care of a proper scaling and coordinate transformation between
-#      the map frame of reference (in cm) and the display (in pixels)
-class Canvas:
-    def __init__(self,map_size=210):
-        self.map_size    = map_size;    # in cm;
-        self.canvas_size = 768;         # in pixels;
-        self.margin      = 0.05*map_size;
-        self.scale       = self.canvas_size/(map_size+2*self.margin);
-
-    def drawLine(self,line):
-        x1 = self.__screenX(line[0]);
-        y1 = self.__screenY(line[1]);
-        x2 = self.__screenX(line[2]);
-        y2 = self.__screenY(line[3]);
-        print("drawLine:" + str((x1,y1,x2,y2)))
-
-    def draw(self,data):
-        display = [(self.__screenX(d[0]),self.__screenY(d[1])) + d[2:] for d in data];
-        print("drawParticles:" + str(display));
-
-    def __screenX(self,x):
-        return (x + self.margin)*self.scale
-
-    def __screenY(self,y):
-        return (self.map_size + self.margin - y)*self.scale
-
-def gausses(sigma):
-    return [random.gauss(0, sigma) for _ in range(SAMPLE_SIZE)]
-
 def trans_coord(pos):
     x, y, theta, _ = pos
     return (x * 10 + 100, 500 - y * 10, theta)
 
-canvas = Canvas();
-
-# A Map class containing walls
-class Map:
-    def __init__(self):
-        self.walls = [];
-
-    def add_wall(self,wall):
-        self.walls.append(wall);
+LEFT_MOTOR_PORT = robot_io.RobotIO.PORT_C
+RIGHT_MOTOR_PORT = robot_io.RobotIO.PORT_D
+SONAR_PORT = robot_io.RobotIO.PORT_4
+# Sonar port -> beam direction relative to the heading (radians). With more
+# than one beam every stop reads them all and weighs the particles on the
+# whole batch, see Robot.weight_beams.
+SONAR_BEAMS = {SONAR_PORT: 0.0}
 
-    def clear(self):
-        self.walls = [];
+# The real BrickPi3 unless ROBOT_IO=sim selects the simulated one
+def open_board():
+    bp = robot_io.open_brickpi(walls=real_walls, pose=(SX, SY, 0),
+                               one_cm_dist=ONE_CM_DIST, pi_turn=PI_TURN, sonar_bearings=SONAR_BEAMS)
+    bp.reset_all()
+    for port in SONAR_BEAMS:
+        bp.set_sensor_type(port, bp.SENSOR_TYPE.NXT_ULTRASONIC)
+    return bp
 
-    def draw(self):
-        for wall in self.walls:
-            canvas.drawLine(wall);
+# Hardware bring-up happens on first use, not at import
+BP = robot_io.RobotContext(open_board)
 
-def distance(pos1, pos2):
-    x1, y1 = pos1
-    x2, y2 = pos2
-    return math.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2)
 
 
 
@@ -161,6 +179,14 @@ def distance(pos1, pos2):
 
 
 
+# Wheel degrees (left, right) for an on-the-spot left turn of 0 ~ 2pi;
+# anything past pi is done as the shorter right turn
+def turn_wheel_degrees(turn_left_radian):
+    if turn_left_radian < math.pi:
+        return PI_TURN * turn_left_radian, -PI_TURN * turn_left_radian
+    return -PI_TURN * (2 * math.pi - turn_left_radian), PI_TURN * (2 * math.pi - turn_left_radian)
+
+
 class MoveStatus(Enum):
     WALK_STRAIGHT = 0
     TURN_LEFT = 1
@@ -168,7 +194,7 @@ class MoveStatus(Enum):
 
 
 class Robot:
-    def __init__(self, *, l, r, cms):
+    def __init__(self, *, l, r, cms, noise=None):
         # cms : current move status
         self.l_mileage_cms = l
         self.r_mileage_cms = r
@@ -176,24 +202,44 @@ class Robot:
         self.segment = 0
         self.round = 0
         self.step = 0
-        self.samples = [(SX, SY, 0, 1 / SAMPLE_SIZE)
-                        for _ in range(SAMPLE_SIZE)]
-        self.history = self.samples
+        self.noise = noise or NoiseSource(MOTION_SIGMAS, MOTION_CORRELATION, block_size=NOISE_BLOCK_SIZE)
+        self.rng = self.noise.spawn()
+        self.particles = ParticleSet.at(SX, SY, 0, SAMPLE_SIZE)
+        self.history = TrajectoryHistory()
+        self.history.append(self.particles)
         self.map = Map()
         BP.set_motor_limits(LEFT_MOTOR_PORT, 100, 300)
         BP.set_motor_limits(RIGHT_MOTOR_PORT, 100, 300)
+        self.sonar_sampler = None
+        self.weigher = None
+        self.settled_at = BP.time()
+        self.sensed_at = BP.time()
+        self.raster = None
+        self.likelihoods = LikelihoodAverages()
+        self.kidnapped = False
+        self.motion = AsyncMotion(BP, LEFT_MOTOR_PORT, RIGHT_MOTOR_PORT, SONAR_PORT,
+                                  one_cm_dist=ONE_CM_DIST, pi_turn=PI_TURN,
+                                  sonar_rate=SONAR_SAMPLE_RATE)
+        self.odometry = Odometry(BP, LEFT_MOTOR_PORT, RIGHT_MOTOR_PORT,
+                                 one_cm_dist=ONE_CM_DIST, pi_turn=PI_TURN, rng=self.noise.spawn())
+
+    # Compatibility view: the particles as a list of (x, y, theta, w) tuples.
+    @property
+    def samples(self):
+        return self.particles.as_tuples()
+
+    @samples.setter
+    def samples(self, samples):
+        if not isinstance(samples, ParticleSet):
+            samples = ParticleSet.from_tuples(samples)
+        self.particles = samples
 
     def drawWall(self):
-        self.map.add_wall((0,0,0,168));        # a
-        self.map.add_wall((0,168,84,168));     # b
-        self.map.add_wall((84,126,84,210));    # c
-        self.map.add_wall((84,210,168,210));   # d
-        self.map.add_wall((168,210,168,84));   # e
-        self.map.add_wall((168,84,210,84));    # f
-        self.map.add_wall((210,84,210,0));     # g
-        self.map.add_wall((210,0,0,0));        # h
+        for line in arena.draw_lines:
+            self.map.add_wall(line)
         self.map.draw()
         
+    @timed("robot.motor_settle")
     def inc_motor_positions(self, l_radian, r_radian):
         _, _, old_l_mileage, _  = BP.get_motor_status(LEFT_MOTOR_PORT)
         BP.set_motor_position(LEFT_MOTOR_PORT, old_l_mileage + l_radian)
@@ -202,13 +248,157 @@ class Robot:
         pre_l_mileage = old_l_mileage
         pre_r_mileage = old_r_mileage
         while True:
-            time.sleep(0.01)
+            BP.sleep(0.01)
             _, _, l_mileage, _  = BP.get_motor_status(LEFT_MOTOR_PORT)
             _, _, r_mileage, _  = BP.get_motor_status(RIGHT_MOTOR_PORT)
             if (pre_l_mileage == l_mileage and pre_r_mileage == r_mileage):
                 break
             pre_l_mileage = l_mileage
             pre_r_mileage = r_mileage
+        self.settled_at = BP.time()
+
+    # Called at a stop: after a kidnap injection, forget the pose and find
+    # it again with localize_globally. Returns False only if that fails.
+    def recover_if_lost(self):
+        if not (KIDNAP_RECOVERY and self.kidnapped):
+            return True
+        self.kidnapped = False
+        print("Lost track of the pose, localizing again")
+        instrument.count("recovery.relocalized")
+        return self.localize_globally()
+
+    # Forget the pose: particles spread uniformly over free space
+    def start_global_localization(self, n=GLOBAL_SAMPLE_SIZE):
+        if self.raster is None:
+            self.raster = OccupancyRaster(real_walls)
+        self.particles = self.raster.sample(n, self.rng)
+        self.history.append(self.particles)
+
+    # Turn on the spot and weigh until the particles settle on one pose,
+    # then check it (see GLOBAL_CHECK_DIST). Particles that drift out of
+    # free space are dropped. Returns whether it converged within
+    # GLOBAL_MAX_STEPS updates.
+    @timed("robot.global_localization")
+    def localize_globally(self, n=GLOBAL_SAMPLE_SIZE):
+        self.start_global_localization(n)
+        full_turn = math.ceil(2 * math.pi / GLOBAL_TURN)
+        spread_at = 0       # step the set was last spread over the map
+        turn_from = 0       # step the current turn started at
+        checking = False
+        settled = misfits = 0
+        for step in range(GLOBAL_MAX_STEPS):
+            sonar = self.accurate_sonar_read()
+            p = self.particles
+            if checking:
+                # Scored on the predicted pose, before this reading moves it
+                x, y, theta = p.estimate()
+                expected = sonar_ground_truth(real_walls, x, y, theta)
+                if (expected is None or
+                        abs(sonar - expected) > GLOBAL_MISFIT_RANGE + GLOBAL_CONVERGED_THETA * expected):
+                    misfits += 1
+            # Anneal from GLOBAL_TEMPER to the full model over the first turn
+            temper = min(1.0, GLOBAL_TEMPER + (1 - GLOBAL_TEMPER) * (step - spread_at) / full_turn)
+            log_likelihoods = np.where(self.raster.contains(p.x, p.y),
+                                       temper * sonar_log_likelihoods(p.x, p.y, p.theta, sonar),
+                                       np.nan)
+            weighted = p.reweighted_log(log_likelihoods)
+            self.history.append(weighted)
+            self.draw(weighted)
+            instrument.count("global.steps")
+            if misfits > GLOBAL_CHECK_MISFITS:
+                # Settled on a look-alike: start over from here
+                instrument.count("global.rejected")
+                self.start_global_localization(n)
+                spread_at = turn_from = step + 1
+                checking = False
+                settled = misfits = 0
+                self.turn_by_radian(GLOBAL_TURN)
+                continue
+            # Judged on the weighted set, where injected particles that do
+            # not fit the reading no longer count
+            settled = settled + 1 if converged(weighted, GLOBAL_CONVERGED_XY, GLOBAL_CONVERGED_THETA) else 0
+            if settled >= GLOBAL_CONVERGED_STEPS and step + 1 >= turn_from + full_turn:
+                if checking:
+                    # Tracking from here: back to a normal sized set. With
+                    # KIDNAP_RECOVERY it keeps injecting uniform particles
+                    # if the readings stop fitting
+                    self.particles = weighted.select(RESAMPLER(weighted.w, SAMPLE_SIZE, self.rng))
+                    self.likelihoods.reset()
+                    return True
+                x, y, theta = weighted.estimate()
+                ahead = min(sonar, sonar_ground_truth(real_walls, x, y, theta) or 0)
+                leg = min(GLOBAL_CHECK_DIST, ahead - GLOBAL_CHECK_CLEARANCE)
+                if leg >= GLOBAL_CHECK_DIST / 2:
+                    self.particles = weighted
+                    self.move_forward_by_dist_update_samples(leg)
+                    turn_from = step + 1
+                    checking = True
+                    settled = 0
+                    continue
+                # No room ahead: keep turning until there is
+            if effective_sample_size(weighted.w) < RESAMPLE_ESS_RATIO * len(weighted):
+                # The whole budget while the posterior is still multi-modal;
+                # KLD-sampling would shrink it after the first reading
+                weighted = self.roughened(weighted.select(RESAMPLER(weighted.w, n, self.rng)))
+                fresh = int(GLOBAL_RANDOM_FRACTION * len(weighted))
+                if fresh:
+                    weighted = self.mixed_with_uniform(weighted, fresh)
+            self.particles = weighted
+            self.turn_by_radian(GLOBAL_TURN)
+            self.particles = self.calc_turn_error(GLOBAL_TURN)
+        return False
+
+    # Resampled copies of one particle all sit on the same pose; spread
+    # them a little so the sparse global set can close in on the truth
+    def roughened(self, samples):
+        n = len(samples)
+        return ParticleSet(samples.x + self.rng.normal(0, GLOBAL_JITTER_XY, n),
+                           samples.y + self.rng.normal(0, GLOBAL_JITTER_XY, n),
+                           (samples.theta + self.rng.normal(0, GLOBAL_JITTER_THETA, n)) % (2 * math.pi),
+                           samples.w)
+
+    # The last `fresh` particles of a uniformly weighted set replaced by
+    # uniform draws over free space
+    def mixed_with_uniform(self, samples, fresh):
+        return self.with_uniform(samples.select(np.arange(len(samples) - fresh)), fresh)
+
+    # A uniformly weighted set with `fresh` uniform draws over free space
+    # added
+    def with_uniform(self, samples, fresh):
+        uniform = self.raster.sample(fresh, self.rng)
+        n = len(samples) + fresh
+        return ParticleSet(np.concatenate([samples.x, uniform.x]),
+                           np.concatenate([samples.y, uniform.y]),
+                           np.concatenate([samples.theta, uniform.theta]),
+                           np.full(n, 1 / n))
+
+    def start_sonar_sampler(self):
+        if self.sonar_sampler is None:
+            self.sonar_sampler = SonarSampler(BP, SONAR_PORT, SONAR_SAMPLE_RATE)
+        self.sonar_sampler.start()
+
+    # The pool and its shared buffer are released by stop_parallel_weighting,
+    # or at exit if nothing else does
+    def use_parallel_weighting(self, processes=None):
+        from parallel_weights import ParallelWeigher
+        if self.weigher is None:
+            self.weigher = ParallelWeigher(real_wall_table, processes, robust=ROBUST_SONAR_MODEL)
+            atexit.register(self.stop_parallel_weighting)
+        return self.weigher
+
+    def stop_parallel_weighting(self):
+        if self.weigher is not None:
+            self.weigher.close()
+            self.weigher = None
+
+    def stop_sonar_sampler(self):
+        if self.sonar_sampler is not None:
+            self.sonar_sampler.stop()
+
+    # Stop everything running beside the main loop
+    def close(self):
+        self.stop_sonar_sampler()
+        self.stop_parallel_weighting()
 
     def move_forward_by_dist(self, dist_cm):
         radii = ONE_CM_DIST * dist_cm
@@ -219,38 +409,123 @@ class Robot:
         turn_left_radian: 0 ~ 2pi
         """
         assert 0 <= turn_left_radian <= 2 * math.pi
-        if turn_left_radian < math.pi:
-            self.inc_motor_positions(PI_TURN * turn_left_radian, -PI_TURN * turn_left_radian)
+        self.inc_motor_positions(*turn_wheel_degrees(turn_left_radian))
+
+    # Drive the wheels by l_degrees, r_degrees while tracking. Returns once
+    # both encoders have settled.
+    @timed("robot.drive_tracking")
+    def drive_tracking(self, l_degrees, r_degrees):
+        self.odometry.reset()
+        l_start, r_start = self.odometry.last
+        BP.set_motor_position(LEFT_MOTOR_PORT, l_start + l_degrees)
+        BP.set_motor_position(RIGHT_MOTOR_PORT, r_start + r_degrees)
+        previous = self.odometry.last
+        self.sensed_at = BP.time()
+        while True:
+            BP.sleep(ODOMETRY_PERIOD)
+            self.track_step()
+            if self.odometry.last == previous:
+                break
+            previous = self.odometry.last
+        self.settled_at = BP.time()
+
+    # One tracking step while the motors run: particles follow the
+    # encoders, and are weighed on a single sonar reading every
+    # DRIVING_SENSE_PERIOD
+    def track_step(self):
+        self.particles = self.odometry.propagate(self.particles)
+        instrument.count("odometry.steps")
+        if BP.time() - self.sensed_at >= DRIVING_SENSE_PERIOD:
+            self.sense_while_driving(self.sensed_at)
+            self.sensed_at = BP.time()
+
+    # Drive through points without stopping, steering on the tracked pose.
+    # Returns whether the end was reached within FOLLOW_TIMEOUT.
+    @timed("robot.follow_path")
+    def follow_path(self, points):
+        follower = PathFollower(BP, LEFT_MOTOR_PORT, RIGHT_MOTOR_PORT,
+                                one_cm_dist=ONE_CM_DIST, pi_turn=PI_TURN, rate=FOLLOW_RATE)
+        self.odometry.reset()
+        self.sensed_at = BP.time()
+        reached, _ = follower.follow(points, self.cur_pos_no_resample, self.track_step, FOLLOW_TIMEOUT)
+        self.settled_at = BP.time()
+        self.draw(self.particles)
+        self.history.append(self.particles)
+        return reached
+
+    # One measurement update on the move, from the newest sampler reading
+    # since `since`, or a direct read when the sampler is not running
+    def sense_while_driving(self, since):
+        sampler = self.sonar_sampler
+        if sampler is not None and sampler.thread is not None:
+            reading = sampler.latest()
+            if reading is None or reading[0] < since:
+                return
+            sonar = reading[1]
         else:
-            self.inc_motor_positions(
-                -PI_TURN * (2 * math.pi - turn_left_radian), 
-                PI_TURN * (2 * math.pi - turn_left_radian))
+            try:
+                sonar = BP.get_sensor(SONAR_PORT)
+            except robot_io.SensorError:
+                instrument.count("sonar.sensor_error")
+                return
+        new_samples = self.weight_samples(sonar)
+        if self.needs_resample(new_samples):
+            new_samples = self.select_survived_samples(new_samples)
+        self.particles = new_samples
     
+    # Run the filter open loop over a recorded run (runlog.open_loop_events):
+    # encoder changes move the particles through the odometry model, and
+    # the sonar readings taken between two moves are weighed as their
+    # median, like accurate_sonar_read at a stop. Nothing is asked of the
+    # log in a set order, so a changed filter or another ROBOT_SEED runs on
+    # the same data without diverging. Returns the estimate after each
+    # measurement update.
+    def replay_open_loop(self, records):
+        estimates = []
+        readings = []
+        for event in runlog.open_loop_events(records, LEFT_MOTOR_PORT, RIGHT_MOTOR_PORT, SONAR_PORT):
+            if event[0] == "sonar":
+                readings.append(event[2])
+                continue
+            if readings:
+                estimates.append(self.replay_update(np.median(readings)))
+                readings = []
+            self.particles = self.odometry.apply(self.particles, event[2], event[3])
+            instrument.count("odometry.steps")
+        if readings:
+            estimates.append(self.replay_update(np.median(readings)))
+        return estimates
+
+    def replay_update(self, sonar):
+        new_samples = self.weight_samples(sonar)
+        if self.needs_resample(new_samples):
+            new_samples = self.select_survived_samples(new_samples)
+        self.particles = new_samples
+        self.history.append(new_samples)
+        self.draw(new_samples)
+        return self.cur_pos_no_resample()
+
+    @timed("robot.draw")
     def draw(self, samples):
-        canvas.draw(samples)
+        get_canvas().draw(samples)
 
     def resample_cur_pos(self):
         self.resample()
         return self.cur_pos_no_resample()
 
     # Return the current position by taking weighted average from all particles.
+    @timed("robot.estimate")
     def cur_pos_no_resample(self):
-        x = 0
-        y = 0
-        theta_x = 0
-        theta_y = 0
-        for (xx, yy, tt, ww) in self.samples:
-            x += xx * ww
-            y += yy * ww
-            theta_x += math.cos(tt) * ww
-            theta_y += math.sin(tt) * ww
-        return [x, y, math.atan2(theta_y, theta_x) % (2 * math.pi)]
+        return self.particles.estimate()
 
+    @timed("robot.to_point")
     def to_point(self, x, y):
         while True:
             # turn stage: adjust robot's angle
             ####################
             self.localization_and_draw()
+            if not self.recover_if_lost():
+                return False
 
             cur_x, cur_y, theta = self.cur_pos_no_resample()
             target_angle = math.atan2(y - cur_y, x - cur_x)
@@ -262,8 +537,7 @@ class Robot:
             if 0.05 * math.pi < dtheta < 1.95 * math.pi:
                 # turn
                 self.turn_by_radian(dtheta)
-                new_samples = self.calc_turn_error(dtheta)
-                self.samples = new_samples
+                self.particles = self.calc_turn_error(dtheta)
                 self.localization_and_draw()
 
 
@@ -275,10 +549,10 @@ class Robot:
             print(f"Remaining distance: {dist}")
             if dist <= 1:
                 # we are at the point, thus done
-                return
+                return True
             elif dist <= 10:
                 self.move_forward_by_dist_update_samples(dist)
-                return
+                return True
             elif dist <= 40:
                 # go without resampling
                 self.move_forward_by_dist_update_samples(dist / 2)
@@ -286,72 +560,194 @@ class Robot:
                 # After going forward 20cm, loop back to adjust robot's angle.
                 self.move_forward_by_dist_update_samples(20)
 
+    # Like to_point, but each leg is driven in one go with drive_tracking:
+    # no 20 cm hops and no sensing stops, only a turn when the heading is off.
+    @timed("robot.to_point")
+    def to_point_driving(self, x, y):
+        while True:
+            if not self.recover_if_lost():
+                return False
+            cur_x, cur_y, theta = self.cur_pos_no_resample()
+            dist = distance((cur_x, cur_y), (x, y))
+            my_print(f"pos: ({cur_x}, {cur_y}), target: ({x}, {y}), remaining: {dist}")
+            if dist <= 1:
+                return True
+            target_angle = math.atan2(y - cur_y, x - cur_x)
+            dtheta = (target_angle - theta) % (2 * math.pi)
+            if 0.02 * math.pi < dtheta < 1.98 * math.pi:
+                self.drive_tracking(*turn_wheel_degrees(dtheta))
+                cur_x, cur_y, theta = self.cur_pos_no_resample()
+                dist = distance((cur_x, cur_y), (x, y))
+            self.drive_tracking(ONE_CM_DIST * dist, ONE_CM_DIST * dist)
+            self.draw(self.particles)
+            self.history.append(self.particles)
+            if dist <= 10:
+                return True
+
+    # Same route logic as to_point, but motions are awaited instead of
+    # slept through: the sonar is sampled throughout, beside the moves,
+    # particle prediction runs once the motor command is out, and the
+    # update uses the readings taken since the motors settled.
+    async def to_point_async(self, x, y):
+        self.motion.start_sampling()
+        while True:
+            await self.localization_and_draw_async()
+
+            cur_x, cur_y, theta = self.cur_pos_no_resample()
+            target_angle = math.atan2(y - cur_y, x - cur_x)
+            dtheta = (target_angle - theta) % (2 * math.pi)
+
+            my_print(f"pos: ({cur_x}, {cur_y}), target: ({x}, {y})")
+            my_print(f"target_angle: {target_angle}, theta: {theta}, dtheta: {dtheta}")
+
+            if 0.05 * math.pi < dtheta < 1.95 * math.pi:
+                await asyncio.gather(self.motion.turn(dtheta), self.predict_async(self.calc_turn_error, dtheta))
+                await self.localization_and_draw_async()
+
+            cur_x, cur_y, theta = self.cur_pos_no_resample()
+            dist = distance((cur_x, cur_y), (x, y))
+
+            print(f"Remaining distance: {dist}")
+            if dist <= 1:
+                return
+            elif dist <= 10:
+                await self.move_forward_by_dist_update_samples_async(dist)
+                return
+            elif dist <= 40:
+                await self.move_forward_by_dist_update_samples_async(dist / 2)
+            else:
+                await self.move_forward_by_dist_update_samples_async(20)
+
+    async def localization_and_draw_async(self):
+        sonar = await self.motion.settled_sonar_median(SONAR_MIN_READINGS)
+        new_samples = self.weight_samples(sonar)
+        self.draw(new_samples)
+        if self.needs_resample(new_samples):
+            new_samples = self.select_survived_samples(new_samples)
+            self.draw(new_samples)
+        self.particles = new_samples
+        self.history.append(new_samples)
+
+    async def move_forward_by_dist_update_samples_async(self, dist):
+        await asyncio.gather(self.motion.move_forward(dist), self.predict_async(self.calc_move_forward_error, dist))
+
+    # gather() starts its tasks in order, so by the time this runs the
+    # motion task has sent its command and is waiting on the motors
+    async def predict_async(self, predict, amount):
+        self.particles = predict(amount)
+
+    @timed("robot.localization")
     def localization_and_draw(self):
         new_samples = self.read_sonar_calc_new_samples()
         self.draw(new_samples)
         # show for 0.5 sec
-        time.sleep(0.5)
-        new_samples = self.select_survived_samples(new_samples)
-        self.draw(new_samples)
-        self.samples = new_samples
+        with instrument.span("robot.draw_pause"):
+            BP.sleep(0.5)
+        if self.needs_resample(new_samples):
+            new_samples = self.select_survived_samples(new_samples)
+            self.draw(new_samples)
+        else:
+            instrument.count("resample.skipped")
+        self.particles = new_samples
+        self.history.append(new_samples)
 
     def move_forward_by_dist_update_samples(self, dist):
         self.move_forward_by_dist(dist)
-        new_samples = self.calc_move_forward_error(dist)
-        self.samples = new_samples
+        self.particles = self.calc_move_forward_error(dist)
 
 
+    @timed("robot.predict_forward")
     def calc_move_forward_error(self, dist):
-        def new_sample_go_straight(cur_pos, distance_error_weight, angle_error_weight, dist):
-            x, y, theta, w = cur_pos
-            nx = x + dist * (1 + distance_error_weight) * math.cos(theta)
-            ny = y + dist * (1 + distance_error_weight) * math.sin(theta)
-            ntheta = (theta + dist * angle_error_weight) % (2 * math.pi)
-            return (nx, ny, ntheta, w)
-        dist_error_by_xy = gausses(ES)
-        dist_error_by_theta = gausses(FS)
-        new_samples = []
+        dist_error_by_xy, dist_error_by_theta, _ = self.noise.draw(len(self.particles))
         # Update particles stages after moving forward
-        for s, d, a in zip(self.samples, dist_error_by_xy, dist_error_by_theta):
-            new_samples.append(new_sample_go_straight(s, d, a, dist))
-        return new_samples
+        return self.particles.moved_forward(dist, dist_error_by_xy, dist_error_by_theta)
 
+    @timed("robot.predict_turn")
     def calc_turn_error(self, turn_left_radian):
-        def new_sample_turn(cur_pos, angle_error_weight):
-            x, y, theta, w = cur_pos
-            ntheta = (theta + turn_left_radian * (1 + angle_error_weight)) % (2 * math.pi)
-            return (x, y, ntheta, w)
-        angle_error_by_theta = gausses(FS)
-        new_samples = []
+        _, _, angle_error_by_theta = self.noise.draw(len(self.particles))
         # Update particles stages after turning
-        for s, a in zip(self.samples, angle_error_by_theta):
-            new_samples.append(new_sample_turn(s, a))
-        return new_samples
+        return self.particles.turned(turn_left_radian, angle_error_by_theta)
 
     def read_sonar_calc_new_samples(self):
-        sonar = self.accurate_sonar_read()
-        new_samples = []
-        for s in self.samples:
-            x, y, theta, weight = s
-            likelihood = calculate_likelihood(x, y, theta, sonar)
-            if likelihood is not None:
-                new_samples.append((x, y, theta, weight * likelihood))
-
-        # Normalisation
-        normaliser = sum([w for _, _, _, w in new_samples])
-        new_samples = [(x, y, theta, w / normaliser) for x, y, theta, w in new_samples]
-        return new_samples
-
+        if len(SONAR_BEAMS) > 1:
+            return self.weight_beams(*self.accurate_sonar_beams())
+        return self.weight_samples(self.accurate_sonar_read())
+
+    @timed("robot.likelihood")
+    def weight_samples(self, sonar):
+        p = self.particles
+        if USE_LIKELIHOOD_FIELD:
+            log_likelihoods = field_log_likelihoods(p.x, p.y, p.theta, sonar)
+            self.likelihoods.update(p.log_mean_likelihood(log_likelihoods))
+            weighted = p.reweighted_log(log_likelihoods)
+        elif self.weigher is not None and len(p) >= PARALLEL_MIN_PARTICLES:
+            # The pool hands back weights only, so no kidnap check here
+            weighted = self.weigher.weigh(p, sonar)
+        elif ROBUST_SONAR_MODEL:
+            log_likelihoods = sonar_log_likelihoods(p.x, p.y, p.theta, sonar)
+            self.likelihoods.update(p.log_mean_likelihood(log_likelihoods))
+            weighted = p.reweighted_log(log_likelihoods)
+        else:
+            likelihoods = calculate_likelihoods(p.x, p.y, p.theta, sonar)
+            with np.errstate(divide="ignore"):
+                self.likelihoods.update(p.log_mean_likelihood(np.log(np.asarray(likelihoods, dtype=np.float64))))
+            # Particles outside the walls are dropped, then normalise
+            weighted = p.reweighted(likelihoods).normalised()
+        instrument.count("particles.out_of_map", len(p) - len(weighted))
+        return weighted
+
+    # Measurement update from a batch of (bearing, range) readings, e.g. a
+    # sweep or several sonars. The log-likelihoods of all beams are summed.
+    @timed("robot.likelihood")
+    def weight_beams(self, bearings, ranges):
+        p = self.particles
+        log_likelihoods = beam_log_likelihoods(p.x, p.y, p.theta, bearings, ranges,
+                                               robust=ROBUST_SONAR_MODEL)
+        self.likelihoods.update(p.log_mean_likelihood(log_likelihoods))
+        weighted = p.reweighted_log(log_likelihoods)
+        instrument.count("particles.out_of_map", len(p) - len(weighted))
+        instrument.count("sonar.beams", len(bearings))
+        return weighted
+
+    # Resample once the weights have degenerated, or straight away when
+    # the kidnap check wants fresh particles
+    def needs_resample(self, samples):
+        if KIDNAP_RECOVERY and self.likelihoods.random_fraction() > 0:
+            return True
+        return effective_sample_size(samples.w) < RESAMPLE_ESS_RATIO * len(samples)
+
+    @timed("robot.resample")
     def select_survived_samples(self, new_samples):
-        weights = [w for _, _, _, w in new_samples]
-        survived_samples = random.choices(new_samples, weights=weights, k=SAMPLE_SIZE)
-        assert len(survived_samples) == SAMPLE_SIZE
-        return [(x, y, theta, 1 / SAMPLE_SIZE) for (x, y, theta, _) in survived_samples]
+        instrument.count("resample.count")
+        if ADAPTIVE_SAMPLE_SIZE:
+            survived = kld_resample(new_samples, KLD_MIN_SAMPLES, KLD_MAX_SAMPLES, RESAMPLER, rng=self.rng)
+        else:
+            indices = RESAMPLER(new_samples.w, SAMPLE_SIZE, self.rng)
+            assert len(indices) == SAMPLE_SIZE
+            survived = new_samples.select(indices)
+        fresh = int(self.likelihoods.random_fraction() * RECOVERY_SAMPLES) if KIDNAP_RECOVERY else 0
+        if fresh:
+            instrument.count("recovery.injected", fresh)
+            self.likelihoods.reset()
+            self.kidnapped = True
+            if self.raster is None:
+                self.raster = OccupancyRaster(real_walls)
+            survived = self.with_uniform(survived, fresh)
+        return survived
 
     
     # Return the median of 11 sonar readings to reduce effect of garbage readings.
+    # With the background sampler running, use the readings it took since
+    # the robot stopped; only fall back to reading here if too few arrive.
+    @timed("robot.sonar_read")
     def accurate_sonar_read(self):
-        time.sleep(1.5)
+        sampler = self.sonar_sampler
+        if sampler is not None and sampler.thread is not None:
+            with instrument.span("robot.sonar_wait"):
+                ready = sampler.wait_for(SONAR_MIN_READINGS, self.settled_at, SONAR_WAIT_TIMEOUT)
+            if ready:
+                return sampler.median(11, since=self.settled_at)
+        BP.sleep(1.5)
         readings = []
         ix = 1
         while ix <= 11:
@@ -360,27 +756,108 @@ class Robot:
                 value = BP.get_sensor(SONAR_PORT)
                 readings.append(value)
                 ix += 1
-            except brickpi3.SensorError as error:
+            except robot_io.SensorError as error:
+                instrument.count("sonar.sensor_error")
                 print(error)
-            time.sleep(0.1)
+            BP.sleep(0.1)
 
         readings.sort()
         sonar = readings[5]
         return sonar
 
+    # Same pause and 11 rounds as accurate_sonar_read, but each round reads
+    # every port in SONAR_BEAMS, so one stop gives a median per beam.
+    # Returns (bearings, ranges) for weight_beams.
+    @timed("robot.sonar_read")
+    def accurate_sonar_beams(self):
+        ports = list(SONAR_BEAMS)
+        BP.sleep(1.5)
+        readings = {port: [] for port in ports}
+        rounds = 0
+        while rounds < 11:
+            for port in ports:
+                try:
+                    readings[port].append(BP.get_sensor(port))
+                except robot_io.SensorError as error:
+                    instrument.count("sonar.sensor_error")
+                    print(error)
+            rounds += 1
+            BP.sleep(0.1)
+        ports = [port for port in ports if readings[port]]
+        bearings = np.array([SONAR_BEAMS[port] for port in ports])
+        ranges = np.array([np.median(readings[port]) for port in ports])
+        return bearings, ranges
+
 def main():
     current_status = Robot(
         l=BP.get_motor_status(LEFT_MOTOR_PORT)[2],
         r=BP.get_motor_status(RIGHT_MOTOR_PORT)[2],
         cms=MoveStatus.WALK_STRAIGHT)
     current_status.drawWall()
-    time.sleep(2)
+    try:
+        tour(current_status)
+    except runlog.ReplayFinished as error:
+        # ROBOT_IO=replay only works while the run asks for the same
+        # readings as the recorded one; --open-loop replays any run
+        print(f"Replay diverged from the recorded run: {error}")
+    finally:
+        current_status.close()
+
+# Open-loop replay of the log named by ROBOT_REPLAY, see
+# Robot.replay_open_loop:
+#     ROBOT_IO=replay ROBOT_REPLAY=LOG python tutorial4.py --open-loop
+def main_open_loop():
+    records = runlog.load(os.environ["ROBOT_REPLAY"])
+    current_status = Robot(l=0, r=0, cms=MoveStatus.WALK_STRAIGHT)
+    current_status.drawWall()
+    estimates = current_status.replay_open_loop(records)
+    print(f"Replayed {len(estimates)} measurement updates")
+    print(f"Final position: {current_status.cur_pos_no_resample()}")
+
+def tour(current_status):
+    if USE_SONAR_SAMPLER and BP.threaded_sensing:
+        current_status.start_sonar_sampler()
+    BP.sleep(2)
+    if GLOBAL_LOCALIZATION and not current_status.localize_globally():
+        print("Global localization did not converge, not driving")
+        return
+    if FOLLOW_PATH:
+        if not current_status.follow_path(nav_points):
+            print("Path following timed out")
+        print(f"Expected location: {nav_points[-1][0]}, {nav_points[-1][1]}")
+        print(f"Actual position: {current_status.cur_pos_no_resample()}")
+        return
     for pos in nav_points:
-        current_status.to_point(pos[0], pos[1])
+        if TRACK_WHILE_DRIVING:
+            reached = current_status.to_point_driving(pos[0], pos[1])
+        else:
+            reached = current_status.to_point(pos[0], pos[1])
+        if not reached:
+            print("Lost the pose and could not localize again, stopping")
+            return
         print(f"Expected location: {pos[0]}, {pos[1]}")
         print(f"Actual position: {current_status.cur_pos_no_resample()}")
-        time.sleep(0.5)
+        BP.sleep(0.5)
+
+async def main_async():
+    current_status = Robot(
+        l=BP.get_motor_status(LEFT_MOTOR_PORT)[2],
+        r=BP.get_motor_status(RIGHT_MOTOR_PORT)[2],
+        cms=MoveStatus.WALK_STRAIGHT)
+    current_status.drawWall()
+    try:
+        for pos in nav_points:
+            await current_status.to_point_async(pos[0], pos[1])
+            print(f"Expected location: {pos[0]}, {pos[1]}")
+            print(f"Actual position: {current_status.cur_pos_no_resample()}")
+    finally:
+        current_status.motion.stop_sampling()
 
 
 if __name__ == "__main__":
-    main()
+    if "--async" in sys.argv:
+        asyncio.run(main_async())
+    elif "--open-loop" in sys.argv:
+        main_open_loop()
+    else:
+        main()
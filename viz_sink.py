@@ -0,0 +1,220 @@
+import atexit
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+# Binary frame layout (little endian):
+#     header: magic b"VIZ1", kind (u8), sequence (u32), timestamp (f64), count (u32)
+#     PARTICLES payload: count records of x, y (i16, 0.1 px), theta (u16, 2pi/65536), w (f16)
+#     LINE payload: x1, y1, x2, y2 (f32, px)
+HEADER = struct.Struct("<4sBIdI")
+MAGIC = b"VIZ1"
+PARTICLES = 0
+LINE = 1
+PARTICLE_DTYPE = np.dtype([("x", "<i2"), ("y", "<i2"), ("theta", "<u2"), ("w", "<f2")])
+LINE_DTYPE = np.dtype("<f4")
+THETA_SCALE = 65536 / (2 * np.pi)
+
+
+def encode_particles(seq, xs, ys, thetas, ws):
+    records = np.empty(len(xs), dtype=PARTICLE_DTYPE)
+    records["x"] = np.clip(np.round(np.asarray(xs) * 10), -32768, 32767)
+    records["y"] = np.clip(np.round(np.asarray(ys) * 10), -32768, 32767)
+    records["theta"] = np.round((np.asarray(thetas) % (2 * np.pi)) * THETA_SCALE).astype(np.int64) % 65536
+    records["w"] = ws
+    return HEADER.pack(MAGIC, PARTICLES, seq, time.time(), len(records)) + records.tobytes()
+
+
+def encode_line(seq, line):
+    payload = np.asarray(line, dtype=LINE_DTYPE).tobytes()
+    return HEADER.pack(MAGIC, LINE, seq, time.time(), 4) + payload
+
+
+# Read binary frames back: yields (kind, seq, timestamp, data), where data
+# is a PARTICLE_DTYPE record array (x, y scaled back to px, theta to
+# radians via decode_particles) or the 4 line coordinates.
+def decode_frames(data):
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        magic, kind, seq, timestamp, count = HEADER.unpack_from(data, offset)
+        if magic != MAGIC:
+            raise ValueError(f"bad frame magic at byte {offset}")
+        offset += HEADER.size
+        dtype = PARTICLE_DTYPE if kind == PARTICLES else LINE_DTYPE
+        size = count * dtype.itemsize
+        yield kind, seq, timestamp, np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        offset += size
+
+
+def decode_particles(records):
+    return (records["x"] / 10.0, records["y"] / 10.0,
+            records["theta"] / THETA_SCALE, records["w"].astype(np.float64))
+
+
+class StdoutTransport:
+    binary = False
+
+    def write(self, payload):
+        if isinstance(payload, bytes):
+            sys.stdout.buffer.write(payload)
+            sys.stdout.buffer.flush()
+        else:
+            sys.stdout.write(payload)
+            sys.stdout.flush()
+
+    def close(self):
+        pass
+
+
+class FileTransport:
+    def __init__(self, path, binary=True):
+        self.binary = binary
+        self.file = open(path, "ab" if binary else "a")
+
+    def write(self, payload):
+        self.file.write(payload)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# Datagrams to a local viewer: a unix socket path, or (host, port) for
+# UDP. A viewer that is not listening just means frames are dropped.
+class SocketTransport:
+    binary = True
+
+    def __init__(self, address):
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.address = address
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.dropped = 0
+
+    def write(self, payload):
+        try:
+            self.sock.sendto(payload, self.address)
+        except OSError:
+            self.dropped += 1
+
+    def close(self):
+        self.sock.close()
+
+
+# Sends draw calls to a transport from a background thread:
+#     - draw_particles() only stores the newest frame and returns, older
+#       frames that were not sent yet are dropped, and at most max_fps
+#       particle frames per second go out
+#     - frames are capped at max_particles (evenly subsampled) so output
+#       volume stays bounded whatever the particle count or history
+#     - draw_line() messages are queued and never dropped
+#     - text transports get the legacy "drawParticles:" / "drawLine:"
+#       lines, binary ones the VIZ1 frames above
+class VizSink:
+    def __init__(self, transport, max_fps=10.0, max_particles=2000):
+        self.transport = transport
+        self.min_interval = 1.0 / max_fps if max_fps else 0.0
+        self.max_particles = max_particles
+        self.seq = 0
+        self.frames_dropped = 0
+        self.pending_lines = []
+        self.pending_frame = None
+        self.last_sent = 0.0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="viz-sink", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def draw_particles(self, xs, ys, thetas, ws=None):
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        thetas = np.asarray(thetas, dtype=np.float64)
+        ws = np.full(len(xs), 1 / max(len(xs), 1)) if ws is None else np.asarray(ws, dtype=np.float64)
+        if len(xs) > self.max_particles:
+            keep = np.linspace(0, len(xs) - 1, self.max_particles).astype(np.intp)
+            xs, ys, thetas, ws = xs[keep], ys[keep], thetas[keep], ws[keep]
+        with self.cond:
+            if self.pending_frame is not None:
+                self.frames_dropped += 1
+            # Copies, so the caller is free to keep mutating its arrays
+            self.pending_frame = (xs.copy(), ys.copy(), thetas.copy(), ws.copy())
+            self.cond.notify()
+
+    def draw_line(self, line):
+        with self.cond:
+            self.pending_lines.append(tuple(line))
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        self.transport.close()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.closed or self.pending_lines or self.pending_frame is not None)
+                lines, self.pending_lines = self.pending_lines, []
+                wait = self.last_sent + self.min_interval - time.monotonic()
+                frame = None
+                if self.pending_frame is not None and (wait <= 0 or self.closed):
+                    frame, self.pending_frame = self.pending_frame, None
+                closed = self.closed and self.pending_frame is None and not self.pending_lines
+            for line in lines:
+                self._send_line(line)
+            if frame is not None:
+                self._send_frame(frame)
+                self.last_sent = time.monotonic()
+            elif wait > 0 and not lines:
+                time.sleep(wait)
+            if closed and frame is None and not lines:
+                return
+
+    def _send_line(self, line):
+        self.seq += 1
+        if self.transport.binary:
+            self.transport.write(encode_line(self.seq, line))
+        else:
+            self.transport.write("drawLine:" + str(line) + "\n")
+
+    def _send_frame(self, frame):
+        self.seq += 1
+        xs, ys, thetas, ws = frame
+        if self.transport.binary:
+            self.transport.write(encode_particles(self.seq, xs, ys, thetas, ws))
+        else:
+            display = list(zip(xs.tolist(), ys.tolist(), thetas.tolist(), ws.tolist()))
+            self.transport.write("drawParticles:" + str(display) + "\n")
+
+
+# Build a sink from a spec string (or the VIZ_SINK environment variable):
+#     "stdout" (legacy text), "stdout-bin", "file:PATH", "unix:PATH",
+#     "udp:HOST:PORT"
+def from_spec(spec=None, **kwargs):
+    spec = spec or os.environ.get("VIZ_SINK", "stdout")
+    if spec == "stdout":
+        transport = StdoutTransport()
+    elif spec == "stdout-bin":
+        transport = StdoutTransport()
+        transport.binary = True
+    elif spec.startswith("file:"):
+        transport = FileTransport(spec[len("file:"):])
+    elif spec.startswith("unix:"):
+        transport = SocketTransport(spec[len("unix:"):])
+    elif spec.startswith("udp:"):
+        host, port = spec[len("udp:"):].rsplit(":", 1)
+        transport = SocketTransport((host, int(port)))
+    else:
+        raise ValueError(f"unknown viz sink: {spec}")
+    return VizSink(transport, **kwargs)
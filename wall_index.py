@@ -0,0 +1,179 @@
+import math
+
+import numpy as np
+
+from raycast import ENDPOINT_EPS, PARALLEL_EPS, wall_segments
+
+
+# Uniform grid over wall segments for ray queries on large maps:
+#     - each cell keeps the indices of the segments passing through it
+#       (stored CSR style: cell_start / cell_items)
+#     - a ray walks the cells it crosses with a 2-D DDA and stops at the
+#       first cell whose nearest hit lies inside that cell
+class WallGrid:
+    def __init__(self, walls, cell_size=None):
+        segments = wall_segments(walls)
+        self.segment_list = segments
+        self.px = [s[0] for s in segments]
+        self.py = [s[1] for s in segments]
+        self.ex = [s[2] - s[0] for s in segments]
+        self.ey = [s[3] - s[1] for s in segments]
+
+        if segments:
+            xs = self.px + [s[2] for s in segments]
+            ys = self.py + [s[3] for s in segments]
+            x_min, x_max, y_min, y_max = min(xs), max(xs), min(ys), max(ys)
+        else:
+            x_min = x_max = y_min = y_max = 0.0
+        self.extent = (x_min, x_max, y_min, y_max)
+        if cell_size is None:
+            # Aim for a handful of cells per segment
+            extent = max(x_max - x_min, y_max - y_min, 1.0)
+            cell_size = extent / max(1, math.ceil(2 * math.sqrt(len(segments))))
+        self.cell_size = cell_size
+        # Pad by one cell so segments on the boundary sit inside the grid
+        self.x0 = x_min - cell_size
+        self.y0 = y_min - cell_size
+        self.nx = int(math.ceil((x_max - x_min) / cell_size)) + 2
+        self.ny = int(math.ceil((y_max - y_min) / cell_size)) + 2
+
+        cells = [[] for _ in range(self.nx * self.ny)]
+        for i, (x1, y1, x2, y2) in enumerate(segments):
+            for ix, iy, _ in self._traverse(x1, y1, x2 - x1, y2 - y1, 1.0):
+                cells[ix * self.ny + iy].append(i)
+        self.cell_start = np.zeros(len(cells) + 1, dtype=np.int64)
+        self.cell_start[1:] = np.cumsum([len(c) for c in cells])
+        self.cell_items = [i for c in cells for i in c]
+
+    def __len__(self):
+        return len(self.segment_list)
+
+    # The table interface (see raycast.SegmentTable), so a grid can stand
+    # in for a table in lookup grids, distance fields and cache keys
+    def arrays(self):
+        return tuple(np.asarray(a, dtype=np.float64) for a in (self.px, self.py, self.ex, self.ey))
+
+    def segments(self):
+        return np.asarray(self.segment_list, dtype=np.float64).reshape(-1, 4)
+
+    def bounds(self):
+        return self.extent
+
+    # Yield (ix, iy, t_exit) for every cell a ray o + t * d crosses with
+    # t in [0, t_end]; t is measured from the original origin.
+    def _traverse(self, x, y, dx, dy, t_end):
+        cs = self.cell_size
+        gx1 = self.x0 + self.nx * cs
+        gy1 = self.y0 + self.ny * cs
+
+        # Clip against the grid box (slab test) to find where the ray enters
+        t_enter, t_exit = 0.0, t_end
+        for o, d, lo, hi in ((x, dx, self.x0, gx1), (y, dy, self.y0, gy1)):
+            if abs(d) < PARALLEL_EPS:
+                if not lo <= o <= hi:
+                    return
+            else:
+                ta, tb = (lo - o) / d, (hi - o) / d
+                if ta > tb:
+                    ta, tb = tb, ta
+                t_enter, t_exit = max(t_enter, ta), min(t_exit, tb)
+        if t_enter > t_exit:
+            return
+
+        sx, sy = x + t_enter * dx, y + t_enter * dy
+        ix = min(max(int((sx - self.x0) // cs), 0), self.nx - 1)
+        iy = min(max(int((sy - self.y0) // cs), 0), self.ny - 1)
+        if abs(dx) < PARALLEL_EPS:
+            step_x, t_max_x, t_delta_x = 0, math.inf, math.inf
+        else:
+            step_x = 1 if dx > 0 else -1
+            t_max_x = (self.x0 + (ix + (dx > 0)) * cs - x) / dx
+            t_delta_x = cs / abs(dx)
+        if abs(dy) < PARALLEL_EPS:
+            step_y, t_max_y, t_delta_y = 0, math.inf, math.inf
+        else:
+            step_y = 1 if dy > 0 else -1
+            t_max_y = (self.y0 + (iy + (dy > 0)) * cs - y) / dy
+            t_delta_y = cs / abs(dy)
+
+        while 0 <= ix < self.nx and 0 <= iy < self.ny:
+            t_cell_exit = min(t_max_x, t_max_y)
+            yield ix, iy, t_cell_exit
+            if t_cell_exit > t_end:
+                return
+            if abs(t_max_x - t_max_y) <= ENDPOINT_EPS * cs:
+                # Through a cell corner, to within rounding: visit both
+                # side neighbours as well, so a wall ending at that corner
+                # is not skipped, then step diagonally
+                if 0 <= ix + step_x < self.nx:
+                    yield ix + step_x, iy, t_cell_exit
+                if 0 <= iy + step_y < self.ny:
+                    yield ix, iy + step_y, t_cell_exit
+                ix += step_x
+                iy += step_y
+                t_max_x += t_delta_x
+                t_max_y += t_delta_y
+            elif t_max_x < t_max_y:
+                ix += step_x
+                t_max_x += t_delta_x
+            else:
+                iy += step_y
+                t_max_y += t_delta_y
+
+    # Distance to the first wall hit by a ray from (x, y) heading theta,
+    # or None if it leaves the map without hitting anything.
+    def cast(self, x, y, theta):
+        hit = self.cast_hit(x, y, theta)
+        return None if hit is None else hit[0]
+
+    # (distance, cosine of the incidence angle) for the first wall hit,
+    # or None for a miss.
+    def cast_hit(self, x, y, theta):
+        dx, dy = math.cos(theta), math.sin(theta)
+        start, items = self.cell_start, self.cell_items
+        px, py, ex, ey = self.px, self.py, self.ex, self.ey
+        best = math.inf
+        best_cos = math.nan
+        tested = set()
+        for ix, iy, t_cell_exit in self._traverse(x, y, dx, dy, math.inf):
+            cell = ix * self.ny + iy
+            for k in range(start[cell], start[cell + 1]):
+                i = items[k]
+                if i in tested:
+                    continue
+                tested.add(i)
+                denom = dx * ey[i] - dy * ex[i]
+                if abs(denom) < PARALLEL_EPS:
+                    continue
+                qx, qy = px[i] - x, py[i] - y
+                t = (qx * ey[i] - qy * ex[i]) / denom
+                u = (qx * dy - qy * dx) / denom
+                if 0 <= t < best and -ENDPOINT_EPS <= u <= 1 + ENDPOINT_EPS:
+                    best = t
+                    best_cos = abs(denom) / math.hypot(ex[i], ey[i])
+            # A hit inside this cell can't be beaten by any later cell
+            if best <= t_cell_exit:
+                return best, best_cos
+        return None if math.isinf(best) else (best, best_cos)
+
+    # cast() over arrays of poses, NaN for misses.
+    def cast_many(self, xs, ys, thetas):
+        xs, ys, thetas = np.broadcast_arrays(np.atleast_1d(xs), np.atleast_1d(ys), np.atleast_1d(thetas))
+        out = np.full(xs.shape, np.nan)
+        for n, (x, y, theta) in enumerate(zip(xs.tolist(), ys.tolist(), thetas.tolist())):
+            d = self.cast(x, y, theta)
+            if d is not None:
+                out[n] = d
+        return out
+
+    # cast_hit() over arrays of poses: (distances, incidence cosines),
+    # NaN for misses.
+    def cast_many_incidence(self, xs, ys, thetas):
+        xs, ys, thetas = np.broadcast_arrays(np.atleast_1d(xs), np.atleast_1d(ys), np.atleast_1d(thetas))
+        out = np.full(xs.shape, np.nan)
+        cos = np.full(xs.shape, np.nan)
+        for n, (x, y, theta) in enumerate(zip(xs.tolist(), ys.tolist(), thetas.tolist())):
+            hit = self.cast_hit(x, y, theta)
+            if hit is not None:
+                out[n], cos[n] = hit
+        return out, cos